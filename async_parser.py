@@ -0,0 +1,242 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from metrics import metrics
+from parse_scheduler import AGING_PAGES, job_rank
+
+logger = logging.getLogger(__name__)
+
+# Error text that means the key is out of quota or being throttled
+QUOTA_ERROR_MARKERS = ("429", "rate limit", "too many requests", "quota", "exceeded")
+
+class AllKeysFailed(Exception):
+    pass
+
+class PageBudgetExhausted(AllKeysFailed):
+    """No key has enough of its page budget left for the job"""
+
+def is_quota_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in QUOTA_ERROR_MARKERS)
+
+class KeySlot(object):
+    """Scheduling state for one LlamaParse API key"""
+
+    def __init__(self, index, api_key, backend, concurrency, min_interval, page_budget=None):
+        self.index = index
+        self.api_key = api_key
+        self.backend = backend
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.page_budget = page_budget
+        self.in_flight = 0
+        self.next_start = 0.0
+        self.cooldown_until = 0.0
+        self.pages_used = 0
+        self.pages_reserved = 0
+        self.stats = {"jobs": 0, "errors": 0, "cooldowns": 0}
+
+    def pages_left(self):
+        """Pages of the budget not yet used or reserved by running jobs (inf without a budget)"""
+        if self.page_budget is None:
+            return float('inf')
+        return self.page_budget - self.pages_used - self.pages_reserved
+
+    def ready_at(self, now, pages=0):
+        """Earliest time this key can take a job of pages, or None if it is full or over budget"""
+        if self.in_flight >= self.concurrency or pages > self.pages_left():
+            return None
+        return max(now, self.next_start, self.cooldown_until)
+
+class AsyncLlamaParser(object):
+    """Parses many documents at once, spread across all configured API keys.
+
+    Every key gets its own backend (a LlamaParse instance in production, any
+    object with an async aget_json_result(file_path) in tests), a concurrency
+    limit and an optional request rate. Jobs that need different parser
+    options (such as target_pages) get a one-off backend from
+    backend_factory(api_key, **options) on the key they are scheduled on.
+    A key that hits a quota or 429 error is put on cooldown and its job is
+    retried on another key; the backends are never rebuilt.
+
+    Jobs say how many pages they are. Waiting jobs are started shortest
+    first (with aging, see parse_scheduler.job_rank), so one large protocol
+    does not hold up many small ones. With a page_budget, every key is
+    given at most that many pages per run; a job goes to the ready key with
+    the least budget that still fits it, keeping room on the others for
+    large jobs, and a job no key has room for fails with
+    PageBudgetExhausted instead of stalling mid-run.
+
+    Use parse()/parse_many() from async code, or start() and submit() to feed
+    jobs from worker threads into a background event loop.
+    """
+
+    def __init__(self, api_keys, backend_factory, per_key_concurrency=2, requests_per_minute=None,
+                 cooldown=60.0, max_attempts=None, page_budget=None, aging_pages=AGING_PAGES):
+        min_interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        # Slots keep the key's position in api_keys so results can name the key that produced them
+        self.backend_factory = backend_factory
+        self.slots = [KeySlot(index, key, backend_factory(key), per_key_concurrency, min_interval, page_budget)
+                      for index, key in enumerate(api_keys) if key]
+        if not self.slots:
+            raise ValueError("No LlamaParse API keys configured")
+        self.cooldown = cooldown
+        self.max_attempts = max_attempts or 2 * len(self.slots)
+        self.aging_pages = aging_pages
+        self._sequence = itertools.count()
+        self._waiting = {}
+        self._condition = None
+        self._loop = None
+        self._thread = None
+
+    async def parse(self, file_path, options=None, pages=None):
+        """Parse one document of pages pages (None if unknown) and return the LlamaParse JSON result and the index of the key used"""
+        last_error = None
+        for attempt in range(self.max_attempts):
+            slot = await self._acquire(file_path, pages or 0)
+            quota_hit = False
+            parsed_pages = None
+            started = time.perf_counter()
+            try:
+                backend = self.backend_factory(slot.api_key, **options) if options else slot.backend
+                json_objs = await backend.aget_json_result(file_path)
+                parsed_pages = sum(len(result.get("pages", [])) for result in json_objs)
+                slot.stats["jobs"] += 1
+                metrics.observe("llamaparse_seconds", time.perf_counter() - started, key=slot.index + 1)
+                metrics.inc("llamaparse_jobs_total", key=slot.index + 1, result="ok")
+                metrics.inc("llamaparse_pages_total", parsed_pages, key=slot.index + 1)
+                return json_objs, slot.index
+            except Exception as e:
+                last_error = e
+                slot.stats["errors"] += 1
+                quota_hit = is_quota_error(e)
+                metrics.inc("llamaparse_jobs_total", key=slot.index + 1, result="quota" if quota_hit else "error")
+                logger.warning(f"API key {slot.index + 1} failed on {file_path} "
+                               f"(attempt {attempt + 1}/{self.max_attempts}): {e}")
+            finally:
+                await self._release(slot, pages or 0, parsed_pages, cooldown=quota_hit)
+
+        raise AllKeysFailed(f"Unable to process {file_path}: {last_error}")
+
+    async def parse_many(self, file_paths):
+        """Parse all documents concurrently; returns {file_path: parse() result or exception}"""
+        results = await asyncio.gather(*(self.parse(file_path) for file_path in file_paths), return_exceptions=True)
+        return dict(zip(file_paths, results))
+
+    def start(self):
+        """Run the scheduler on a background event loop for submit()"""
+        if self._thread is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="llamaparse-loop", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, file_path, options=None, pages=None):
+        """Schedule a parse from any thread; returns a concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.parse(file_path, options, pages), self._loop)
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._thread = None
+            self._loop = None
+            self._condition = None
+
+    def backend(self, key_index):
+        """Backend for the key at position key_index in api_keys"""
+        for slot in self.slots:
+            if slot.index == key_index:
+                return slot.backend
+        raise KeyError(f"No backend for API key {key_index + 1}")
+
+    @property
+    def stats(self):
+        stats = {}
+        for slot in self.slots:
+            stats[f"key_{slot.index + 1}"] = dict(slot.stats, in_flight=slot.in_flight, pages_used=slot.pages_used)
+            if slot.page_budget is not None:
+                stats[f"key_{slot.index + 1}"]["pages_left"] = slot.pages_left()
+        return stats
+
+    def queue_stats(self):
+        """Jobs and pages waiting for a key, and how long the oldest has waited"""
+        waiting = list(self._waiting.values())
+        now = time.monotonic()
+        return {
+            "waiting": len(waiting),
+            "waiting_pages": sum(pages for _, pages, _ in waiting),
+            "oldest_wait": round(max((now - queued for _, _, queued in waiting), default=0.0), 1),
+            "in_flight": sum(slot.in_flight for slot in self.slots),
+            "in_flight_pages": sum(slot.pages_reserved for slot in self.slots)
+        }
+
+    def _over_budget(self, pages):
+        """True if no key could take a job of pages even once its running jobs finish"""
+        return all(slot.page_budget is not None and pages > slot.page_budget - slot.pages_used for slot in self.slots)
+
+    def _choose(self, now, pages):
+        """(start time, slot) of the key a job of pages should go to, or None if none can take it yet"""
+        ready = [(slot.ready_at(now, pages), slot.pages_left(), slot.in_flight, slot.index, slot)
+                 for slot in self.slots if slot.ready_at(now, pages) is not None]
+        if not ready:
+            return None
+        start_at, _, _, _, slot = min(ready)
+        return start_at, slot
+
+    async def _acquire(self, file_path, pages):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        loop = asyncio.get_running_loop()
+        sequence = next(self._sequence)
+        rank = job_rank(pages, sequence, self.aging_pages)
+        queued = time.monotonic()
+        async with self._condition:
+            self._waiting[sequence] = (rank, pages, queued)
+            try:
+                while True:
+                    if self._over_budget(pages):
+                        metrics.inc("llamaparse_budget_refused_total")
+                        raise PageBudgetExhausted(f"No API key has {pages} pages of budget left for {file_path}")
+                    now = loop.time()
+                    choice = self._choose(now, pages)
+                    # A better ranked job that a key can take now goes first
+                    ahead = any(other_rank < rank and (self._choose(now, other_pages) or (float('inf'),))[0] <= now
+                                for other_rank, other_pages, _ in self._waiting.values())
+                    if choice and not ahead:
+                        start_at, slot = choice
+                        if start_at <= now:
+                            slot.in_flight += 1
+                            slot.pages_reserved += pages
+                            slot.next_start = now + slot.min_interval
+                            metrics.observe("llamaparse_queue_seconds", time.monotonic() - queued)
+                            return slot
+                        timeout = start_at - now
+                    else:
+                        # Every key is full, over budget for this job or taken by a better ranked one; wait for a release
+                        timeout = None
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                del self._waiting[sequence]
+                # Jobs ranked behind this one may be able to start now
+                self._condition.notify_all()
+
+    async def _release(self, slot, pages, parsed_pages=None, cooldown=False):
+        loop = asyncio.get_running_loop()
+        async with self._condition:
+            slot.in_flight -= 1
+            slot.pages_reserved -= pages
+            if parsed_pages is not None:
+                slot.pages_used += parsed_pages
+            if cooldown:
+                slot.cooldown_until = loop.time() + self.cooldown
+                slot.stats["cooldowns"] += 1
+                logger.warning(f"API key {slot.index + 1} hit its quota, cooling down for {self.cooldown:g}s")
+            self._condition.notify_all()
@@ -0,0 +1,287 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from metrics import collect, metrics
+from parse_scheduler import ShortestFirstQueue
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the work stream on a stage queue
+_DONE = object()
+
+def worker_context():
+    """Start method for matching processes that does not fork this (threaded) process.
+
+    Workers start on the first submit, while the stage threads, the
+    LlamaParse event loop and the MongoDB flush timer are running; a forked
+    child could inherit one of their locks (logging, metrics) held and
+    deadlock. forkserver children are forked from a clean server process.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+class BatchPipeline(object):
+    """Pipelined download -> parse -> match -> store run over CSV rows.
+
+    Downloads and LlamaParse jobs are network bound and run in thread pools,
+    section matching is CPU bound and runs in a process pool, and documents
+    are written in batches. Stages are connected by bounded queues, so a slow
+    stage blocks the stages feeding it instead of letting work pile up.
+
+    Stage callables:
+        download(row) -> pdf path or None; an exception with a true
+            .permanent attribute (such as DownloadError for a missing URL or
+            a 404) marks the row failed for good instead of retrying it
+        parse(pdf_path) -> LlamaParse page list
+        match(row, pdf_path, content) -> document or None (must be picklable)
+        store(documents) -> None, or a list of (key, error) for documents that
+            failed to save, key being the document filter ({'NCT Number': ...})
+        cleanup(pdf_path) -> None, called once a row is finished
+        images(pdf_path, content, document) -> None, optional image download
+            stage run on its own thread pool after matching
+        parse_cost(pdf_path) -> page count, optional; downloaded PDFs then
+            wait for a parse worker shortest first instead of in CSV order
+
+    With a JobLedger, rows the ledger says are done (or still backing off)
+    are skipped, and every row's stage and failures are recorded as it goes.
+    """
+
+    def __init__(self, download, parse, match, store, cleanup=None, images=None, parse_cost=None,
+                 download_workers=4, parse_workers=2, match_workers=None,
+                 image_workers=4, batch_size=50, queue_size=None, ledger=None, progress_interval=30.0):
+        self.download = download
+        self.parse = parse
+        self.match = match
+        self.store = store
+        self.cleanup = cleanup
+        self.images = images
+        self.parse_cost = parse_cost
+        self.image_workers = image_workers
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers
+        self.match_workers = match_workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.queue_size = queue_size or 2 * max(download_workers, parse_workers, self.match_workers)
+        self.ledger = ledger
+        self.progress_interval = progress_interval
+        self.stats = {"rows": 0, "skipped": 0, "downloaded": 0, "parsed": 0, "matched": 0, "stored": 0, "failed": 0, "images": 0}
+        self._last_progress = 0.0
+        self._parse_queue = None
+        self._stats_lock = threading.Lock()
+
+    def run(self, rows):
+        download_queue = queue.Queue(self.queue_size)
+        if self.parse_cost:
+            parse_queue = ShortestFirstQueue(self.queue_size, self._parse_pages)
+        else:
+            parse_queue = queue.Queue(self.queue_size)
+        self._parse_queue = parse_queue
+        store_queue = queue.Queue(self.queue_size)
+
+        with ProcessPoolExecutor(max_workers=self.match_workers, mp_context=worker_context()) as match_pool, \
+                ThreadPoolExecutor(max_workers=self.image_workers) as image_pool:
+            self._image_pool = image_pool
+            stages = [
+                self._start_stage("download", self._download_worker, self.download_workers, download_queue, parse_queue),
+                self._start_stage("parse", lambda item: self._parse_worker(item, match_pool), self.parse_workers, parse_queue, store_queue),
+            ]
+            writer = threading.Thread(target=self._store_worker, args=(store_queue,), name="store")
+            writer.start()
+
+            for row in rows:
+                self._count("rows")
+                if self.ledger and not self.ledger.should_process(row.get('NCT Number')):
+                    self._count("skipped")
+                    continue
+                download_queue.put(row)
+            download_queue.put(_DONE)
+
+            for stage in stages:
+                stage.join()
+            writer.join()
+
+        logger.info(f"Batch run finished: {self.stats}")
+        if self.ledger:
+            logger.info(f"Ledger: {self.ledger.progress()}")
+        return self.stats
+
+    def _start_stage(self, name, handle, worker_count, in_queue, out_queue):
+        """Run handle(item) on worker_count threads and forward its results to out_queue"""
+        def worker():
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    # Put the marker back so the sibling workers also stop
+                    in_queue.put(_DONE)
+                    return
+                try:
+                    result = handle(item)
+                except Exception as e:
+                    # A dead worker would stop draining in_queue and block the stage feeding it forever
+                    logger.exception(f"Unexpected error in {name} stage: {e}")
+                    self._count("failed")
+                    continue
+                if result is not None:
+                    out_queue.put(result)
+
+        def coordinator():
+            workers = [threading.Thread(target=worker, name=f"{name}-{i}") for i in range(worker_count)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            out_queue.put(_DONE)
+
+        thread = threading.Thread(target=coordinator, name=name)
+        thread.start()
+        return thread
+
+    def _download_worker(self, row):
+        nct_number = row.get('NCT Number')
+        error = "No PDF downloaded"
+        try:
+            pdf_path = self.download(row)
+        except Exception as e:
+            logger.error(f"Error downloading PDF for {nct_number}: {e}")
+            pdf_path = None
+            error = e
+        if not pdf_path:
+            self._count("failed")
+            self._record_failure(row, error, permanent=getattr(error, 'permanent', False))
+            return None
+        self._count("downloaded")
+        self._record(row, "downloaded")
+        return row, pdf_path
+
+    def _parse_worker(self, item, match_pool):
+        row, pdf_path = item
+        try:
+            content = self.parse(pdf_path)
+        except Exception as e:
+            logger.error(f"Error parsing {pdf_path} for {row.get('NCT Number')}: {e}")
+            self._record_failure(row, e)
+            self._finish(pdf_path, failed=True)
+            return None
+        self._count("parsed")
+        self._record(row, "parsed")
+        # Metrics recorded while matching live in the worker process; collect() sends them back
+        try:
+            future = match_pool.submit(collect, self.match, row, pdf_path, content)
+        except Exception as e:
+            # BrokenProcessPool once a matching process has died (for example out of memory)
+            logger.error(f"Error submitting {pdf_path} for matching: {e}")
+            self._record_failure(row, e)
+            self._finish(pdf_path, failed=True)
+            return None
+        return row, pdf_path, content, future
+
+    def _store_worker(self, store_queue):
+        batch = []
+        while True:
+            item = store_queue.get()
+            if item is _DONE:
+                break
+            row, pdf_path, content, future = item
+            error = "No document built"
+            try:
+                document, snapshot = future.result()
+                metrics.merge(snapshot)
+            except Exception as e:
+                logger.error(f"Error matching sections for {row.get('NCT Number')}: {e}")
+                document = None
+                error = e
+            if document is None:
+                self._record_failure(row, error)
+                self._finish(pdf_path, failed=True)
+                continue
+            self._count("matched")
+            self._record(row, "matched")
+            if self.images:
+                # The PDF is cleaned up once its images are fetched
+                self._image_pool.submit(self._image_worker, pdf_path, content, document)
+            else:
+                self._finish(pdf_path)
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+
+    def _image_worker(self, pdf_path, content, document):
+        try:
+            self.images(pdf_path, content, document)
+            self._count("images")
+        except Exception as e:
+            logger.error(f"Error fetching images for {pdf_path}: {e}")
+        finally:
+            self._finish(pdf_path)
+
+    def _flush(self, batch):
+        try:
+            failures = self.store(batch) or []
+        except Exception as e:
+            logger.error(f"Error storing batch of {len(batch)} documents: {e}")
+            self._count("failed", len(batch))
+            for document in batch:
+                self._record_failure(document, e)
+            self._report_progress()
+            return
+        failed = {key.get('NCT Number'): error for key, error in failures}
+        for document in batch:
+            if document.get('NCT Number') in failed:
+                self._record_failure(document, failed[document.get('NCT Number')])
+            else:
+                self._record(document, "stored")
+        self._count("stored", len(batch) - len(failures))
+        self._count("failed", len(failures))
+        self._report_progress()
+
+    def _record(self, row, stage):
+        if self.ledger and row.get('NCT Number'):
+            self.ledger.mark(row['NCT Number'], stage)
+
+    def _record_failure(self, row, error, permanent=False):
+        if self.ledger and row.get('NCT Number'):
+            self.ledger.fail(row['NCT Number'], error, permanent=permanent)
+
+    def _report_progress(self):
+        now = time.monotonic()
+        if now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        with self._stats_lock:
+            stats = dict(self.stats)
+        done = stats["skipped"] + stats["stored"] + stats["failed"]
+        logger.info(f"Progress: {done}/{stats['rows']} rows read are done ({stats['stored']} stored, "
+                    f"{stats['skipped']} skipped, {stats['failed']} failed)")
+        if isinstance(self._parse_queue, ShortestFirstQueue):
+            logger.info(f"Parse queue: {self._parse_queue.stats()}")
+
+    def _parse_pages(self, item):
+        """Page count of a downloaded row for the parse queue; None for the end marker"""
+        if item is _DONE:
+            return None
+        try:
+            return self.parse_cost(item[1])
+        except Exception as e:
+            logger.warning(f"Could not size {item[1]}: {e}")
+            return 0
+
+    def _finish(self, pdf_path, failed=False):
+        if failed:
+            self._count("failed")
+        if self.cleanup:
+            try:
+                self.cleanup(pdf_path)
+            except OSError as e:
+                logger.warning(f"Could not clean up {pdf_path}: {e}")
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+        metrics.inc("pipeline_rows_total", amount, stage=key)
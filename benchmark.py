@@ -0,0 +1,306 @@
+"""Benchmarks for the protocol extraction pipeline.
+
+Usage:
+    python benchmark.py heading-matcher [--repeat N]
+    python benchmark.py pipeline [--pages 100 500 1000] [--repeat N]
+                                 [--output results.json] [--baseline baseline.json]
+    python benchmark.py import-time [--repeat N]
+
+The pipeline benchmark replays the recorded pages in test_content.json (and
+synthetic documents scaled up from them) through TOC detection, section
+matching, protocol number lookup, document assembly and a stubbed MongoDB
+write. No network or database is touched.
+
+The import-time benchmark imports each entry module in a fresh interpreter
+and fails if one takes longer than its budget or pulls in a dependency that
+should only be loaded when a command needs it.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import bson
+from document_builder import build_document, get_protocol_number
+from mongo_writer import MongoBulkWriter
+from section_matcher import (HeadingMatcher, alternative_names, default_heading_matcher, identify_toc_pages,
+                             match_sections, normalize_heading, similarity)
+
+# Cumulative import time budgets in seconds, as reported by python -X importtime
+IMPORT_BUDGETS = {
+    "clinical_trail_extracter": 0.3,
+    "section_matcher": 0.15,
+    "document_builder": 0.15
+}
+# Heavy dependencies the entry modules must leave until a command needs them
+LAZY_MODULES = ("llama_parse", "llama_index", "nest_asyncio", "pdfminer", "pymongo", "requests")
+
+def measure_import(module):
+    """(cumulative import seconds, lazy modules it imported) in a fresh interpreter"""
+    code = f"import sys, {module}; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    seconds = None
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            seconds = int(fields[1]) / 1e6
+    return seconds, [name for name in result.stdout.strip().split(',') if name]
+
+def bench_import_time(repeat=5):
+    """Print import times against IMPORT_BUDGETS; returns True if any module is over budget"""
+    over_budget = False
+    for module, budget in IMPORT_BUDGETS.items():
+        # The fastest run is the one least disturbed by a cold disk cache
+        runs = [measure_import(module) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        eager = runs[0][1]
+        flag = ""
+        if seconds > budget or eager:
+            flag = "  OVER BUDGET" if seconds > budget else ""
+            flag += f"  eagerly imports {', '.join(eager)}" if eager else ""
+            over_budget = True
+        print(f"{module:<28} {seconds * 1000:8.1f} ms  (budget {budget * 1000:.0f} ms){flag}")
+    return over_budget
+
+def load_fixture_headings(path='test_content.json'):
+    """Pull heading-like lines out of the recorded page text"""
+    with open(path, 'r') as f:
+        pages = json.load(f)
+
+    headings = []
+    for page in pages:
+        for line in page['content'].split('\n'):
+            # Drop TOC dot leaders and trailing page numbers
+            line = re.sub(r'\s*\.{3,}\s*\d*$', '', line).strip()
+            words = line.split()
+            if 0 < len(words) <= 10 and line[0].isalnum() and line[-1] not in '.,;:':
+                headings.append(line)
+    return headings
+
+def naive_match(heading, target):
+    """Heading matching as it was done before HeadingMatcher, used as the reference"""
+    cleaned_heading = re.sub(r'^\d+(\.\d+)*\s*', '', heading).strip().lower()
+    for name in [target] + alternative_names.get(target, []):
+        if cleaned_heading == name.lower() or similarity(cleaned_heading, name.lower()) > 0.8:
+            return name
+    return None
+
+def bench_heading_matcher(repeat=5):
+    headings = load_fixture_headings()
+    targets = list(alternative_names.keys())
+    pairs = len(headings) * len(targets)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = [naive_match(heading, target) for heading in headings for target in targets]
+    naive_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        normalize_heading.cache_clear()
+        matcher = HeadingMatcher(alternative_names)
+        cold = [matcher.match(heading, target) for heading in headings for target in targets]
+    cold_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        warm = [matcher.match(heading, target) for heading in headings for target in targets]
+    warm_time = (time.perf_counter() - start) / repeat
+
+    if cold != expected or warm != expected:
+        raise AssertionError("HeadingMatcher results differ from the reference matcher")
+
+    print(f"{len(headings)} headings x {len(targets)} targets = {pairs} pairs, "
+          f"{sum(1 for name in expected if name)} matches")
+    print(f"naive similarity():     {naive_time * 1000:8.2f} ms")
+    print(f"HeadingMatcher (cold):  {cold_time * 1000:8.2f} ms  ({naive_time / cold_time:5.1f}x)")
+    print(f"HeadingMatcher (warm):  {warm_time * 1000:8.2f} ms  ({naive_time / warm_time:5.1f}x)")
+
+def looks_like_heading(line):
+    return bool(re.match(r'^(\d+(\.\d+)*\.?\s+)?[A-Z][A-Z0-9 ,&/()\-]{3,}$', line))
+
+def load_fixture_content(path='test_content.json'):
+    """Turn the recorded page text into LlamaParse-shaped pages with heading and text items"""
+    with open(path, 'r') as f:
+        recorded = json.load(f)
+
+    content = []
+    for page in recorded:
+        items = []
+        paragraph = []
+        for line in page['content'].split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            if looks_like_heading(line):
+                if paragraph:
+                    items.append({"type": "text", "value": ' '.join(paragraph)})
+                    paragraph = []
+                items.append({"type": "heading", "lvl": 1, "value": line})
+            else:
+                paragraph.append(line)
+        if paragraph:
+            items.append({"type": "text", "value": ' '.join(paragraph)})
+        content.append({"page": page['page_num'], "text": page['content'], "md": page['content'], "items": items})
+    return content
+
+def synthetic_document(fixture, page_count):
+    """Scale the fixture to page_count pages, with the template sections spread evenly through it"""
+    content = []
+    for page_num in range(page_count):
+        page = copy.deepcopy(fixture[page_num % len(fixture)])
+        page['page'] = page_num + 1
+        content.append(page)
+
+    sections = list(alternative_names.keys())
+    stride = max(1, page_count // (len(sections) + 1))
+    for number, section in enumerate(sections, start=1):
+        page = content[min(number * stride, page_count - 1)]
+        page['items'].insert(0, {"type": "heading", "lvl": 1, "value": f"{number} {section.upper()}"})
+        page['items'].insert(2, {"type": "heading", "lvl": 2, "value": f"{number}.1 Overview"})
+    return content
+
+class FakeBulkResult(object):
+    def __init__(self, count):
+        self.bulk_api_result = {"nUpserted": count, "nModified": 0}
+
+class FakeCollection(object):
+    """Stands in for the MongoDB collection"""
+
+    def bulk_write(self, operations, ordered=True):
+        return FakeBulkResult(len(operations))
+
+def reset_caches():
+    """Drop memoized heading results so every run measures cold matching"""
+    normalize_heading.cache_clear()
+    default_heading_matcher.match_normalized.cache_clear()
+    default_heading_matcher._heading_profile.cache_clear()
+
+def persist(document):
+    writer = MongoBulkWriter(FakeCollection(), flush_interval=None)
+    writer.add(document)
+    writer.close()
+    # The driver's share of the write: encoding the document to BSON
+    return len(bson.encode(document))
+
+def pipeline_stages():
+    pdf_path = "benchmark/Bench_Prot_000.pdf"
+    return [
+        ("toc", lambda content, document: identify_toc_pages(content)),
+        ("match", lambda content, document: match_sections(content, pdf_path)),
+        ("protocol_number", lambda content, document: get_protocol_number(content)),
+        ("assemble", lambda content, document: build_document(pdf_path, content)),
+        ("persist", lambda content, document: persist(document)),
+    ]
+
+def measure(stage, content, document, repeat):
+    """Median wall time over repeat runs, plus peak traced memory of one extra run"""
+    timings = []
+    for _ in range(repeat):
+        reset_caches()
+        start = time.perf_counter()
+        stage(content, document)
+        timings.append(time.perf_counter() - start)
+
+    reset_caches()
+    tracemalloc.start()
+    stage(content, document)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    wall_time = sorted(timings)[len(timings) // 2]
+    items = sum(len(page['items']) for page in content)
+    return {
+        "wall_time_s": wall_time,
+        "peak_memory_bytes": peak,
+        "pages": len(content),
+        "items": items,
+        "items_per_s": items / wall_time if wall_time else None
+    }
+
+def bench_pipeline(page_counts, repeat=3):
+    fixture = load_fixture_content()
+    documents = [("fixture", fixture)] + [(str(count), synthetic_document(fixture, count)) for count in page_counts]
+
+    results = {}
+    for name, content in documents:
+        document = build_document("benchmark/Bench_Prot_000.pdf", content)
+        results[name] = {}
+        for stage_name, stage in pipeline_stages():
+            results[name][stage_name] = measure(stage, content, document, repeat)
+            stats = results[name][stage_name]
+            print(f"{name:>8} pages  {stage_name:<16} {stats['wall_time_s'] * 1000:10.2f} ms  "
+                  f"{stats['peak_memory_bytes'] / 1024 ** 2:8.2f} MiB  {stats['items_per_s'] or 0:12.0f} items/s")
+    return results
+
+def compare_to_baseline(results, baseline, tolerance, min_delta=0.001):
+    """Print the change in wall time per stage; returns True if any stage regressed past tolerance.
+
+    Stages that slowed down by less than min_delta seconds are never flagged,
+    since sub-millisecond stages are dominated by timer noise.
+    """
+    regressed = False
+    for name, stages in results.items():
+        for stage_name, stats in stages.items():
+            previous = baseline.get(name, {}).get(stage_name)
+            if not previous or not previous["wall_time_s"]:
+                continue
+            change = stats["wall_time_s"] / previous["wall_time_s"] - 1
+            flag = ""
+            if change > tolerance and stats["wall_time_s"] - previous["wall_time_s"] > min_delta:
+                flag = "  REGRESSION"
+                regressed = True
+            print(f"{name:>8} pages  {stage_name:<16} {change * 100:+8.1f}%{flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the protocol extraction pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    heading_parser = subparsers.add_parser('heading-matcher', help="Fuzzy heading matcher micro-benchmark")
+    heading_parser.add_argument('--repeat', type=int, default=5)
+    pipeline_parser = subparsers.add_parser('pipeline', help="Per-stage benchmark of parse -> match -> persist")
+    pipeline_parser.add_argument('--pages', type=int, nargs='+', default=[100, 500, 1000], help="Synthetic document sizes")
+    pipeline_parser.add_argument('--repeat', type=int, default=3)
+    pipeline_parser.add_argument('--output', default="benchmark_results.json", help="Where to write the results as JSON")
+    pipeline_parser.add_argument('--baseline', help="Results file from an earlier run to compare against")
+    pipeline_parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before a stage counts as a regression")
+    pipeline_parser.add_argument('--min-delta-ms', type=float, default=1.0, help="Ignore slowdowns smaller than this")
+    import_parser = subparsers.add_parser('import-time', help="Check entry module import times against their budgets")
+    import_parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Keep per-section log lines (including missed-section warnings) out of the measurements
+    logging.disable(logging.WARNING)
+
+    if args.command == 'heading-matcher':
+        bench_heading_matcher(args.repeat)
+    elif args.command == 'import-time':
+        if bench_import_time(args.repeat):
+            sys.exit(1)
+    elif args.command == 'pipeline':
+        results = bench_pipeline(args.pages, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump({
+                "created": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "repeat": args.repeat,
+                "results": results
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+        if args.baseline:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)["results"]
+            if compare_to_baseline(results, baseline, args.tolerance, args.min_delta_ms / 1000):
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,125 +1,249 @@
+"""Single entry point for protocol extraction.
+
+Usage:
+    python clinical_trail_extracter.py ingest-csv [ctg-studies2.csv] [--sync] [--sequential] [--workers N] ...
+    python clinical_trail_extracter.py ingest-dir [test] [--hybrid]
+    python clinical_trail_extracter.py match SOURCE [--output FILE] [--save]
+    python clinical_trail_extracter.py export [--format jsonl|parquet] [--output PATH] [--query JSON]
+    python clinical_trail_extracter.py index [--query JSON]
+    python clinical_trail_extracter.py search QUERY [--section NAME] [--limit 20]
+    python clinical_trail_extracter.py compare [--query JSON] [--section NAME] [--output common_unique.json]
+    python clinical_trail_extracter.py rematch [--cache-dir parse_cache] [--report rematch_report.json] [--dry-run]
+    python clinical_trail_extracter.py status
+
+SOURCE is a protocol PDF URL, a local PDF or an already parsed .pages file.
+Stored documents are also added to a local SQLite full-text index of their
+sections (--section-index, SECTION_INDEX_PATH), which search queries.
+Running with just a CSV path (the old invocation) means ingest-csv.
+
+LlamaParse jobs are sized by page count and started shortest first; set
+LLAMA_PARSE_PAGE_BUDGET_PER_KEY to cap the pages each API key parses per run.
+
+LlamaParse, pdfminer, pymongo and requests are imported, and MongoDB and
+LlamaParse clients created, only when a command first needs them, so
+importing this module for extract_pdf_url or match_row_document is cheap
+(see `python benchmark.py import-time`).
+"""
 import os
 import json
 import logging
-from pymongo import MongoClient
-from pdf_extractor import llama_document_parser
-from section_matcher import match_sections
+from document_builder import build_document, add_csv_fields, add_protocol_fields, extract_pdf_url
+from batch_pipeline import BatchPipeline
+from job_ledger import JobLedger
+from metrics import metrics
+from parse_cache import ParseCache
+from page_store import PageStore
 from dotenv import load_dotenv
 import re
 import csv
-import requests
-from urllib.parse import urlparse
+import sys
+import argparse
+import threading
+import time
+from functools import partial
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-# Load the template
-with open('template.json', 'r') as f:
-    template = json.load(f)
-
-# MongoDB connection setup
-mongo_uri = f"mongodb://{os.getenv('MONGO_USERNAME')}:{os.getenv('MONGO_PASSWORD')}@{os.getenv('MONGO_HOST')}:{os.getenv('MONGO_PORT')}/{os.getenv('MONGO_DB')}?authSource=admin"
-client = MongoClient(mongo_uri)
-db = client[os.getenv('MONGO_DB')]
-collection = db[os.getenv('MONGO_COLLECTION')]
-
-def get_drug_name(file_path):
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    return base_name.split('_')[0]
-
-def get_protocol_number(content):
-    pattern = r"(?i)protocol\s*number:?\s*([\w-]+)"
-    for page in content:
-        match = re.search(pattern, page['text'])
-        if match:
-            return match.group(1)
-    return "Protocol Number Not Found"
-
-def process_document(file_path):
-    output_folder = "protocol_images"
-    json_file_path = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(file_path))[0]}_output.json")
+# Shared clients are created on first use by the get_* functions below
+mongo_writer = None
+pdf_downloader = None
+parse_cache = None
+llama_async_parser = None
+section_index = None
+shared_clients_lock = threading.Lock()
+
+# Full-text index that stored sections are added to; empty to turn indexing off
+section_index_path = os.getenv('SECTION_INDEX_PATH', 'section_index.db')
+
+def get_mongo_writer():
+    global mongo_writer
+    with shared_clients_lock:
+        if mongo_writer is None:
+            from mongo_writer import MongoBulkWriter, collection_from_env
+            # Every save writes through with write(); no background flushes
+            mongo_writer = MongoBulkWriter(collection_from_env(), flush_interval=None)
+    return mongo_writer
+
+def get_pdf_downloader():
+    """Connection-pooled session shared by all protocol PDF downloads"""
+    global pdf_downloader
+    with shared_clients_lock:
+        if pdf_downloader is None:
+            from downloader import PdfDownloader
+            pdf_downloader = PdfDownloader()
+    return pdf_downloader
+
+def get_parse_cache():
+    """Local cache of LlamaParse output keyed by PDF hash and parser settings"""
+    global parse_cache
+    with shared_clients_lock:
+        if parse_cache is None:
+            parse_cache = ParseCache(
+                os.getenv('PARSE_CACHE_DIR', 'parse_cache'),
+                max_bytes=int(os.getenv('PARSE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+            )
+    return parse_cache
+
+def get_section_index():
+    """Local full-text index of matched sections, or None if indexing is off"""
+    global section_index
+    with shared_clients_lock:
+        if section_index is None and section_index_path:
+            from section_index import SectionIndex
+            section_index = SectionIndex(section_index_path)
+    return section_index
+
+def get_async_parser():
+    """LlamaParse jobs from every worker share one scheduler over all API keys"""
+    global llama_async_parser
+    with shared_clients_lock:
+        if llama_async_parser is None:
+            from async_parser import AsyncLlamaParser
+            from pdf_extractor import get_api_keys, create_llamaparse
+            requests_per_minute = os.getenv('LLAMA_PARSE_REQUESTS_PER_MINUTE')
+            page_budget = os.getenv('LLAMA_PARSE_PAGE_BUDGET_PER_KEY')
+            llama_async_parser = AsyncLlamaParser(
+                get_api_keys(),
+                create_llamaparse,
+                per_key_concurrency=int(os.getenv('LLAMA_PARSE_CONCURRENCY_PER_KEY', 2)),
+                requests_per_minute=float(requests_per_minute) if requests_per_minute else None,
+                cooldown=float(os.getenv('LLAMA_PARSE_KEY_COOLDOWN', 60)),
+                page_budget=int(page_budget) if page_budget else None
+            ).start()
+    return llama_async_parser
+
+def parse_with_llamaparse(file_path, target_pages=None):
+    """Parse the whole document, or only the given 0-based pages, through the shared key scheduler.
+
+    More pages than LLAMA_PARSE_SHARD_PAGES are split into page-range shards
+    parsed concurrently, LLAMA_PARSE_SHARD_PARALLELISM at a time, so a large
+    protocol takes about as long as its slowest shard.
+    """
+    from page_shards import parse_in_shards
+    from parse_scheduler import document_pages, exact_page_count
+    from pdf_extractor import pages_from_result
+    parser = get_async_parser()
+    shard_size = int(os.getenv('LLAMA_PARSE_SHARD_PAGES', 50))
+    if target_pages is None and shard_size:
+        # Only an exact count can be split; a size estimate would drop pages or ask for ones past the end
+        page_count = exact_page_count(file_path)
+        if page_count and page_count > shard_size:
+            target_pages = range(page_count)
+    if target_pages is None:
+        json_objs, key_index = parser.submit(file_path, pages=document_pages(file_path)).result()
+        return pages_from_result(json_objs, key_index)
+    return parse_in_shards(parser, file_path, target_pages, shard_size,
+                           max_parallel=int(os.getenv('LLAMA_PARSE_SHARD_PARALLELISM', 4)))
+
+def load_or_parse_document(file_path, hybrid=False):
+    from pdf_extractor import PARSER_SETTINGS
+    if hybrid:
+        from content_processor import hybrid_extract, TRIAGE_SETTINGS
+        settings = dict(PARSER_SETTINGS, **TRIAGE_SETTINGS)
+    else:
+        settings = PARSER_SETTINGS
+    parse_cache = get_parse_cache()
+    cache_key = parse_cache.key(file_path, settings)
     
-    try:
-        if os.path.exists(json_file_path):
-            with open(json_file_path, 'r') as f:
-                content = json.load(f)
-            logger.info(f"Loaded existing JSON for {file_path}")
+    def parse():
+        # The parse cache is the store of record for parsed pages
+        if hybrid:
+            # Only scanned or image-heavy pages go to LlamaParse
+            pages = hybrid_extract(file_path, lambda target_pages: parse_with_llamaparse(file_path, target_pages))
         else:
-            llama_parser = llama_document_parser()  # Remove the argument here
-            content = llama_parser.process_and_save(file_path, output_folder)
-            logger.info(f"Processed new document: {file_path}")
-        
-        matched_sections = match_sections(content, file_path)  # Pass file_path here
-        
-        document = {
-            "drug_name": get_drug_name(file_path),
-            "protocol_source": file_path,
-            "protocol_number": get_protocol_number(content),
-        }
-        document.update(matched_sections)
-        
-        return document
+            pages = parse_with_llamaparse(file_path)
+        logger.info(f"Processed new document: {file_path}")
+        return pages
+    
+    content = parse_cache.get_or_create(cache_key, parse, source=file_path)
+    logger.info(f"Parse cache stats: {parse_cache.stats}")
+    return content
+
+def fetch_document_images(pdf_path, content, document):
+    """Download the images referenced by the document's matched sections"""
+    from image_fetcher import SectionImageFetcher
+    folder_name = document.get('NCT Number') or os.path.splitext(os.path.basename(pdf_path))[0]
+    fetcher = SectionImageFetcher(get_async_parser().backend, max_workers=int(os.getenv('IMAGE_FETCH_WORKERS', 8)))
+    return fetcher.fetch(content, document, os.path.join("protocol_images", f"{folder_name}_images"))
+
+def process_document(file_path, hybrid=False):
+    try:
+        content = load_or_parse_document(file_path, hybrid=hybrid)
+        return build_document(file_path, content)
     except Exception as e:
         logger.error(f"Error processing document {file_path}: {e}")
         return None
 
+def index_sections(documents):
+    """Add the documents' sections to the full-text index; indexing errors are logged, not raised"""
+    index = get_section_index()
+    if index is not None:
+        with metrics.timer("index_seconds"):
+            index.replace_many(documents)
+
+def save_many_to_mongodb(documents):
+    """Upsert a batch and index the documents that were stored; returns (key, error) for those that failed to save"""
+    from mongo_writer import document_key
+    failures = get_mongo_writer().write(documents)
+    failed = [key for key, _ in failures]
+    index_sections([document for document in documents if document_key(document) not in failed])
+    return failures
+
 def save_to_mongodb(document):
+    # Written through rather than buffered, so the index only ever holds stored documents
     try:
-        result = collection.insert_one(document)
-        logger.info(f"Document saved to MongoDB with ID: {result.inserted_id}")
+        save_many_to_mongodb([document])
     except Exception as e:
         logger.error(f"Error saving document to MongoDB: {e}")
 
-def download_pdf(url, output_folder):
-    response = requests.get(url)
-    if response.status_code == 200:
-        file_name = os.path.basename(urlparse(url).path)
-        file_path = os.path.join(output_folder, file_name)
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        return file_path
-    else:
-        logger.error(f"Failed to download PDF from {url}")
-        return None
+def flush_mongodb():
+    """Write out buffered documents, if anything was saved this run"""
+    if mongo_writer is not None:
+        return mongo_writer.flush()
+    return []
 
-def main():
-    root_folder = "test"
+def main_dir(root_folder="test", hybrid=False):
     for root, dirs, files in os.walk(root_folder):
         for file in files:
             if file.endswith('.pdf'):
                 file_path = os.path.join(root, file)
                 logger.info(f"Processing file: {file_path}")
-                document = process_document(file_path)
+                document = process_document(file_path, hybrid=hybrid)
                 if document:
-                    save_to_mongodb(document)
+                    # The PDF hash lets rematch find this document again
+                    save_to_mongodb(add_protocol_fields(document, None, file_path))
                 else:
                     logger.warning(f"Skipping file due to processing error: {file_path}")
+    flush_mongodb()
 
-def extract_pdf_url(study_documents):
-    # Split the study_documents string by '|' to separate multiple URLs
-    url_parts = study_documents.split('|')
-    
-    # Define the pattern for matching PDF URLs
-    pattern = r'(https?://\S+?(?:Prot_(?:SAP_)?\d+\.pdf))'
-    
-    for part in url_parts:
-        match = re.search(pattern, part.strip(), re.IGNORECASE)
-        if match:
-            return match.group(1)
-    
-    return None
+def plan_csv_sync(csv_file_path, ledger=None):
+    """Compare the CSV with the studies in MongoDB; only new and changed rows are processed"""
+    from csv_sync import SyncPlan, load_synced_studies
+    stored = load_synced_studies(get_mongo_writer().collection)
+    with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
+        plan = SyncPlan.from_csv(csv.DictReader(csvfile), stored)
+    if ledger:
+        # The ledger would skip changed studies it saw stored before. New studies keep their
+        # ledger state, so one that keeps failing (say a 404) still runs out of attempts
+        for nct_number, reason in plan.pending.items():
+            if reason in ("updated", "protocol changed"):
+                ledger.requeue(nct_number)
+    return plan
 
-def main_csv(csv_file_path):
-    output_folder = "downloaded_pdfs"
-    os.makedirs(output_folder, exist_ok=True)
+def main_csv(csv_file_path, fetch_images=False, hybrid=False, ledger=None, sync=False):
+    plan = plan_csv_sync(csv_file_path, ledger) if sync else None
 
     with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
         csv_reader = csv.DictReader(csvfile)
         for row in csv_reader:
+            if plan and not plan.needs_processing(row):
+                continue
+            if ledger and not ledger.should_process(row['NCT Number']):
+                logger.info(f"Skipping row already done or backing off: {row['NCT Number']}")
+                continue
             logger.info(f"Processing row: {row['NCT Number']}")
             # Extract PDF URL
             study_documents = row.get('Study Documents', '')
@@ -127,30 +251,361 @@ def main_csv(csv_file_path):
             
             if not pdf_url:
                 logger.warning(f"No valid PDF URL found for {row['NCT Number']}")
+                if ledger:
+                    ledger.fail(row['NCT Number'], "No valid PDF URL", permanent=True)
                 continue
 
-            # Download PDF
-            pdf_path = download_pdf(pdf_url, output_folder)
-            if not pdf_path:
+            # Download PDF into the study's own folder; protocols of different studies share file names
+            try:
+                pdf_path = download_row_pdf(row)
+            except Exception as e:
+                logger.error(f"Failed to download PDF from {pdf_url}: {e}")
+                if ledger:
+                    ledger.fail(row['NCT Number'], e, permanent=getattr(e, 'permanent', False))
                 continue
+            if ledger:
+                ledger.mark(row['NCT Number'], "downloaded")
 
             # Process PDF
-            document = process_document(pdf_path)
+            document = process_document(pdf_path, hybrid=hybrid)
             if not document:
                 logger.warning(f"Skipping row due to processing error: {row['NCT Number']}")
+                if ledger:
+                    ledger.fail(row['NCT Number'], "Processing failed")
+                remove_downloaded_pdf(pdf_path)
                 continue
+            if ledger:
+                ledger.mark(row['NCT Number'], "matched")
 
             # Add CSV data to document
-            for key, value in row.items():
-                if key != 'Study Documents':  # Skip this column as we've already processed it
-                    document[key] = value
+            add_csv_fields(document, row)
+            add_protocol_fields(document, pdf_url, pdf_path)
 
-            # Save to MongoDB
-            save_to_mongodb(document)
+            if fetch_images:
+                fetch_document_images(pdf_path, load_or_parse_document(pdf_path, hybrid=hybrid), document)
+
+            # Save to MongoDB; a connection error fails this row, not the whole run
+            try:
+                failures = save_many_to_mongodb([document])
+            except Exception as e:
+                logger.error(f"Error storing {row['NCT Number']} in MongoDB: {e}")
+                if ledger:
+                    ledger.fail(row['NCT Number'], e)
+                remove_downloaded_pdf(pdf_path)
+                continue
+            if plan and not failures:
+                plan.record_stored([document])
+            if ledger:
+                if failures:
+                    ledger.fail(row['NCT Number'], failures[0][1])
+                else:
+                    ledger.mark(row['NCT Number'], "stored")
 
             # Clean up downloaded PDF
-            os.remove(pdf_path)
+            remove_downloaded_pdf(pdf_path)
+    flush_mongodb()
+
+def download_row_pdf(row, output_folder="downloaded_pdfs"):
+    """Download the row's protocol; raises DownloadError, permanent when there is no URL or the server refuses it"""
+    from downloader import DownloadError
+    pdf_url = extract_pdf_url(row.get('Study Documents', ''))
+    if not pdf_url:
+        raise DownloadError(f"No valid PDF URL for {row['NCT Number']}", permanent=True)
+
+    # Protocols from different studies share file names (Prot_000.pdf), so
+    # concurrent downloads each get their own folder
+    row_folder = os.path.join(output_folder, row['NCT Number'])
+    os.makedirs(row_folder, exist_ok=True)
+    return get_pdf_downloader().download(pdf_url, row_folder)
+
+def remove_downloaded_pdf(pdf_path):
+    os.remove(pdf_path)
+    if os.path.exists(f"{pdf_path}.etag"):
+        os.remove(f"{pdf_path}.etag")
+    try:
+        os.rmdir(os.path.dirname(pdf_path))
+    except OSError:
+        pass
+
+def match_row_document(row, pdf_path, content):
+    document = add_csv_fields(build_document(pdf_path, content), row)
+    return add_protocol_fields(document, extract_pdf_url(row.get('Study Documents', '')), pdf_path)
+
+def main_csv_batch(csv_file_path, download_workers=4, parse_workers=2, match_workers=None, batch_size=50, fetch_images=False, hybrid=False, ledger=None, retry_passes=2, max_retry_wait=300, sync=False):
+    from parse_scheduler import document_pages
+    plan = plan_csv_sync(csv_file_path, ledger) if sync else None
+
+    def store(documents):
+        failures = save_many_to_mongodb(documents)
+        if plan:
+            failed = [key.get('NCT Number') for key, _ in failures]
+            plan.record_stored([document for document in documents if document.get('NCT Number') not in failed])
+        return failures
+
+    def run_pass():
+        pipeline = BatchPipeline(
+            download=download_row_pdf,
+            parse=partial(load_or_parse_document, hybrid=hybrid),
+            match=match_row_document,
+            store=store,
+            cleanup=remove_downloaded_pdf,
+            images=fetch_document_images if fetch_images else None,
+            # Downloaded protocols wait for a parse worker shortest first
+            parse_cost=document_pages,
+            download_workers=download_workers,
+            parse_workers=parse_workers,
+            match_workers=match_workers,
+            batch_size=batch_size,
+            ledger=ledger
+        )
+        with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
+            rows = csv.DictReader(csvfile)
+            return pipeline.run(filter(plan.needs_processing, rows) if plan else rows)
+
+    stats = run_pass()
+    # Rows that failed this run are retried once their backoff is over, if that is soon enough
+    for _ in range(retry_passes if ledger else 0):
+        next_retry = ledger.next_retry()
+        if next_retry is None or next_retry - time.time() > max_retry_wait:
+            break
+        wait = max(0, next_retry - time.time())
+        logger.info(f"Retrying failed rows in {wait:.0f}s")
+        time.sleep(wait)
+        stats = run_pass()
+    if ledger:
+        failures = ledger.failures()
+        if failures:
+            logger.warning(f"{len(failures)} rows failed; see the job ledger for errors")
+    if llama_async_parser is not None:
+        logger.info(f"LlamaParse key usage: {llama_async_parser.stats}; queue: {llama_async_parser.queue_stats()}")
+    return stats
+
+def report_metrics(metrics_file=None):
+    summary = metrics.summary()
+    rates = ", ".join(f"{stage} {rate:.1f}" for stage, rate in summary["pages_per_second"].items())
+    logger.info(f"Run took {summary['elapsed_s']:.0f}s; pages per second: {rates or 'n/a'}")
+    if metrics_file:
+        metrics.write(metrics_file)
+        logger.info(f"Wrote metrics to {metrics_file}")
+
+
+def match_source(source, hybrid=False, output_folder="downloaded_pdfs"):
+    """Build the document for a protocol PDF URL, a local PDF or a parsed .pages file"""
+    if source.endswith('.pages'):
+        # Already parsed: matching needs neither LlamaParse nor the PDF
+        with PageStore(source) as content:
+            return build_document(source, content)
+    if re.match(r'https?://', source):
+        os.makedirs(output_folder, exist_ok=True)
+        pdf_path = get_pdf_downloader().download(source, output_folder)
+        try:
+            document = build_document(pdf_path, load_or_parse_document(pdf_path, hybrid=hybrid))
+            return add_protocol_fields(document, source, pdf_path)
+        finally:
+            remove_downloaded_pdf(pdf_path)
+    return add_protocol_fields(build_document(source, load_or_parse_document(source, hybrid=hybrid)), None, source)
+
+def stored_documents(query=None, batch_size=500):
+    """Iterate over the protocol documents in MongoDB that match query"""
+    from mongo_writer import collection_from_env
+    return collection_from_env().find(query or {}, batch_size=batch_size)
+
+def export_documents(output_path, query=None, batch_size=500):
+    """Write the protocol documents matching query to output_path as JSON lines; returns the count"""
+    count = 0
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for document in stored_documents(query, batch_size):
+            f.write(json.dumps(document, default=str) + "\n")
+            count += 1
+    logger.info(f"Exported {count} documents to {output_path}")
+    return count
+
+def index_stored_documents(query=None, batch_size=500):
+    """Rebuild the full-text index entries of the documents in MongoDB; returns the count"""
+    index = get_section_index()
+    count = 0
+    for document in stored_documents(query, batch_size):
+        index.replace(document)
+        count += 1
+    index.optimize()
+    logger.info(f"Indexed {count} documents: {index.stats()}")
+    return count
+
+def compare_documents(output_path, query=None, sections=None, min_documents=2, threshold=0.5, path="near_duplicates.db"):
+    """Write the common and unique paragraphs per section of the documents matching query; returns the report.
+
+    Signatures of documents hashed by earlier runs are reused, so only new
+    or re-matched protocols are hashed.
+    """
+    from near_duplicates import NearDuplicateIndex
+    index = NearDuplicateIndex(path, threshold=threshold)
+    keys = []
+    hashed = 0
+    for document in stored_documents(query):
+        hashed += index.add(document)
+        keys.append(document.get('NCT Number') or document.get('protocol_source'))
+    logger.info(f"Hashed {hashed} new paragraphs from {len(keys)} documents ({index.stats()})")
+
+    report = index.report(sections, min_documents, documents=keys if query else None)
+    for section, clusters in report.items():
+        logger.info(f"{section}: {len(clusters['common'])} common, {len(clusters['unique'])} unique")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+def print_search_results(results):
+    for result in results:
+        title = f"{result['section']} / {result['subsection']}" if result['subsection'] else result['section']
+        print(f"{result['score']:8.2f}  {result['nct_number'] or result['source']}  {title}  (pages {result['start_page']}-{result['end_page']})")
+        print(f"          {' '.join(result['snippet'].split())}")
+
+# Subcommands; a first argument that is none of these is taken as the CSV of ingest-csv
+COMMANDS = ('ingest-csv', 'ingest-dir', 'match', 'export', 'index', 'search', 'compare', 'rematch', 'status')
+
+def parse_args(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = ['ingest-csv'] + argv
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--log-level', default=os.getenv('LOG_LEVEL', 'INFO'))
+    common.add_argument('--metrics-file', default=os.getenv('METRICS_FILE'), help="Write run metrics here: Prometheus text for .prom, JSON otherwise")
+    common.add_argument('--section-index', default=section_index_path, help="SQLite full-text index of stored sections ('' turns indexing off)")
+    parser = argparse.ArgumentParser(description="Extract protocol sections from clinical trial protocols")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    csv_parser = subparsers.add_parser('ingest-csv', parents=[common], help="Process the studies in a ClinicalTrials.gov CSV export")
+    csv_parser.add_argument('csv_file', nargs='?', default="ctg-studies2.csv")
+    csv_parser.add_argument('--sequential', action='store_true', help="Process one row at a time")
+    csv_parser.add_argument('--sync', action='store_true', help="Only process studies that are new or changed (Last Update Posted, protocol URL) since they were stored")
+    csv_parser.add_argument('--download-workers', type=int, default=4, help="Concurrent PDF downloads")
+    csv_parser.add_argument('--concurrency', type=int, default=2, help="Concurrent LlamaParse jobs")
+    csv_parser.add_argument('--workers', type=int, default=None, help="Section matching processes (default: CPU count)")
+    csv_parser.add_argument('--batch-size', type=int, default=50, help="Documents per MongoDB write")
+    csv_parser.add_argument('--fetch-images', action='store_true', help="Download the images referenced by matched sections")
+    csv_parser.add_argument('--hybrid', action='store_true', help="Extract machine-readable pages locally and send only scanned pages to LlamaParse")
+    csv_parser.add_argument('--ledger', default=os.getenv('JOB_LEDGER_PATH', 'job_ledger.db'), help="SQLite job ledger used to resume interrupted runs")
+    csv_parser.add_argument('--no-ledger', action='store_true', help="Process every row, ignoring the job ledger")
+    csv_parser.add_argument('--max-attempts', type=int, default=5, help="Failures after which a row is no longer retried")
+    csv_parser.add_argument('--status', action='store_true', help="Print the job ledger progress and failures, then exit")
+
+    dir_parser = subparsers.add_parser('ingest-dir', parents=[common], help="Process every PDF under a folder")
+    dir_parser.add_argument('folder', nargs='?', default="test")
+    dir_parser.add_argument('--hybrid', action='store_true', help="Extract machine-readable pages locally and send only scanned pages to LlamaParse")
+
+    match_parser = subparsers.add_parser('match', parents=[common], help="Match the sections of one protocol and print the document")
+    match_parser.add_argument('source', help="Protocol PDF URL, local PDF or parsed .pages file")
+    match_parser.add_argument('--output', help="Write the document JSON here instead of stdout")
+    match_parser.add_argument('--save', action='store_true', help="Also upsert the document into MongoDB")
+    match_parser.add_argument('--hybrid', action='store_true', help="Extract machine-readable pages locally and send only scanned pages to LlamaParse")
+
+    export_parser = subparsers.add_parser('export', parents=[common], help="Export the stored protocol documents as JSON lines or Parquet")
+    export_parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl',
+                               help="jsonl: whole documents; parquet: section and table rows, partitioned by section")
+    export_parser.add_argument('--output', help="Output file (jsonl, default protocols.jsonl) or folder (parquet, default protocols_parquet)")
+    export_parser.add_argument('--query', type=json.loads, default=None, help="MongoDB filter as JSON, e.g. '{\"drug_name\": \"X\"}'")
+    export_parser.add_argument('--section', action='append', dest='sections', help="Parquet: only this section; may be repeated")
+    export_parser.add_argument('--partition-by', nargs='+', default=['section'], help="Parquet: partition columns, e.g. section drug_name")
+    export_parser.add_argument('--rows-per-batch', type=int, default=10000, help="Parquet: rows held in memory and written per row group")
+    export_parser.add_argument('--batch-size', type=int, default=500, help="Documents per MongoDB cursor batch")
+
+    index_parser = subparsers.add_parser('index', parents=[common], help="Rebuild the section full-text index from the documents in MongoDB")
+    index_parser.add_argument('--query', type=json.loads, default=None, help="MongoDB filter as JSON; only these documents are re-indexed")
+    index_parser.add_argument('--batch-size', type=int, default=500, help="Documents per MongoDB cursor batch")
+
+    search_parser = subparsers.add_parser('search', parents=[common], help="Ranked full-text search over the indexed sections")
+    search_parser.add_argument('query', help="FTS5 query, e.g. 'eGFR' or '\"renal impairment\" NOT dialysis'")
+    search_parser.add_argument('--section', help="Only sections or subsections with this name, e.g. 'inclusion criteria'")
+    search_parser.add_argument('--limit', type=int, default=20)
+    search_parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+
+    compare_parser = subparsers.add_parser('compare', parents=[common], help="Find the common and unique content of each section across protocols")
+    compare_parser.add_argument('--query', type=json.loads, default=None, help="MongoDB filter as JSON selecting the precedent protocols (default: all)")
+    compare_parser.add_argument('--section', action='append', dest='sections', help="Only this section; may be repeated")
+    compare_parser.add_argument('--min-documents', type=int, default=2, help="Protocols a cluster must span to count as common")
+    compare_parser.add_argument('--threshold', type=float, default=0.5, help="Estimated Jaccard similarity at which paragraphs count as the same content")
+    compare_parser.add_argument('--signatures', default=os.getenv('NEAR_DUPLICATES_PATH', 'near_duplicates.db'), help="SQLite store of paragraph MinHash signatures")
+    compare_parser.add_argument('--output', default="common_unique.json")
+
+    rematch_parser = subparsers.add_parser('rematch', parents=[common], help="Re-run section matching over the cached parses and update MongoDB")
+    rematch_parser.add_argument('--cache-dir', default=os.getenv('PARSE_CACHE_DIR', 'parse_cache'))
+    rematch_parser.add_argument('--legacy-dir', default="protocol_images", help="Folder of <file name>_output.json parses written before the parse cache")
+    rematch_parser.add_argument('--workers', type=int, default=None, help="Matching processes (default: CPU count)")
+    rematch_parser.add_argument('--batch-size', type=int, default=200, help="Documents per MongoDB bulk update")
+    rematch_parser.add_argument('--report', default="rematch_report.json", help="Hit rates of the previous run, replaced by this run's")
+    rematch_parser.add_argument('--dry-run', action='store_true', help="Report hit rates without updating MongoDB or the index")
+
+    status_parser = subparsers.add_parser('status', parents=[common], help="Print the job ledger progress and failures")
+    status_parser.add_argument('--ledger', default=os.getenv('JOB_LEDGER_PATH', 'job_ledger.db'))
+    return parser.parse_args(argv)
+
+def print_status(ledger):
+    print(json.dumps(ledger.progress(), indent=2))
+    for nct_number, attempts, error in ledger.failures():
+        print(f"{nct_number}\t{attempts}\t{error}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    global section_index_path
+    section_index_path = args.section_index
+
+    if args.command == 'status' or (args.command == 'ingest-csv' and args.status):
+        print_status(JobLedger(args.ledger))
+        return
+    if args.command == 'ingest-csv':
+        ledger = None if args.no_ledger else JobLedger(args.ledger, max_attempts=args.max_attempts)
+        if args.sequential:
+            main_csv(args.csv_file, fetch_images=args.fetch_images, hybrid=args.hybrid, ledger=ledger, sync=args.sync)
+        else:
+            main_csv_batch(
+                args.csv_file,
+                download_workers=args.download_workers,
+                parse_workers=args.concurrency,
+                match_workers=args.workers,
+                batch_size=args.batch_size,
+                fetch_images=args.fetch_images,
+                hybrid=args.hybrid,
+                ledger=ledger,
+                sync=args.sync
+            )
+    elif args.command == 'ingest-dir':
+        main_dir(args.folder, hybrid=args.hybrid)
+    elif args.command == 'match':
+        document = match_source(args.source, hybrid=args.hybrid)
+        if args.save:
+            save_to_mongodb(document)
+            flush_mongodb()
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(document, f, indent=2, default=str)
+        else:
+            print(json.dumps(document, indent=2, default=str))
+    elif args.command == 'export' and args.format == 'parquet':
+        from mongo_writer import collection_from_env
+        from parquet_export import export_parquet
+        export_parquet(collection_from_env(), args.output or "protocols_parquet", args.query, args.sections,
+                       args.partition_by, args.rows_per_batch, args.batch_size)
+    elif args.command == 'export':
+        export_documents(args.output or "protocols.jsonl", args.query, args.batch_size)
+    elif args.command in ('index', 'search') and get_section_index() is None:
+        sys.exit(f"{args.command} needs a section index; set --section-index or SECTION_INDEX_PATH")
+    elif args.command == 'index':
+        index_stored_documents(args.query, args.batch_size)
+    elif args.command == 'rematch':
+        from rematch import run_rematch
+        run_rematch(args.cache_dir, args.legacy_dir, args.workers, args.batch_size, args.report,
+                    args.section_index, args.dry_run)
+    elif args.command == 'compare':
+        compare_documents(args.output, args.query, args.sections, args.min_documents, args.threshold, args.signatures)
+    elif args.command == 'search':
+        results = get_section_index().search(args.query, section=args.section, limit=args.limit)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_search_results(results)
+        return
+    report_metrics(args.metrics_file)
 
 if __name__ == "__main__":
-    #main()
-    main_csv("ctg-studies2.csv")
+    main()
@@ -0,0 +1,133 @@
+import logging
+import re
+from statistics import median
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LAParams, LTChar, LTContainer, LTImage, LTTextLine
+
+logger = logging.getLogger(__name__)
+
+# Pages with less extractable text than this have no usable text layer
+MIN_TEXT_CHARS = 100
+# Pages where images cover more of the page than this go to LlamaParse
+MAX_IMAGE_AREA_RATIO = 0.5
+# Lines set this much larger than the page's body text are headings
+HEADING_SIZE_RATIO = 1.15
+
+# Settings that change hybrid output; part of the parse cache key
+TRIAGE_SETTINGS = {
+    "hybrid": True,
+    "min_text_chars": MIN_TEXT_CHARS,
+    "max_image_area_ratio": MAX_IMAGE_AREA_RATIO,
+    "heading_size_ratio": HEADING_SIZE_RATIO
+}
+
+def iter_layout(element):
+    """Yield element and everything nested inside it, stopping at text lines"""
+    yield element
+    if isinstance(element, LTContainer) and not isinstance(element, LTTextLine):
+        for child in element:
+            yield from iter_layout(child)
+
+def read_line(line):
+    """Text, median font size and boldness of a pdfminer text line"""
+    chars = [char for char in line if isinstance(char, LTChar)]
+    text = line.get_text().strip()
+    if not chars:
+        return text, 0.0, False
+    size = median(char.size for char in chars)
+    bold = sum(1 for char in chars if 'bold' in char.fontname.lower()) > len(chars) / 2
+    return text, size, bold
+
+def triage_pages(pdf_path):
+    """Classify every page as machine-readable or scanned.
+
+    Yields (page record, text lines) where the record has the same fields as
+    test_content.json (page_num, content, content_type, word_count,
+    char_count) plus image_area_ratio, and lines are (text, font size, bold).
+    """
+    for page_layout in extract_pages(pdf_path, laparams=LAParams(boxes_flow=None)):
+        lines = []
+        image_area = 0.0
+        for element in iter_layout(page_layout):
+            if isinstance(element, LTTextLine):
+                lines.append(read_line(element))
+            elif isinstance(element, LTImage):
+                image_area += element.width * element.height
+
+        text = '\n'.join(line[0] for line in lines if line[0])
+        page_area = page_layout.width * page_layout.height
+        image_area_ratio = min(1.0, image_area / page_area) if page_area else 0.0
+        readable = len(text) >= MIN_TEXT_CHARS and image_area_ratio <= MAX_IMAGE_AREA_RATIO
+
+        record = {
+            "page_num": page_layout.pageid,
+            "content": text,
+            "content_type": "machine-readable" if readable else "scanned",
+            "word_count": len(text.split()),
+            "char_count": len(text),
+            "image_area_ratio": image_area_ratio
+        }
+        yield record, lines
+
+def is_heading_line(text, size, bold, body_size):
+    words = text.split()
+    if not words or len(words) > 15 or text.endswith(('.', ',', ';')):
+        return False
+    if body_size and size >= body_size * HEADING_SIZE_RATIO:
+        return True
+    if bold:
+        return True
+    # Numbered, upper case section titles such as "5.1 INCLUSION CRITERIA"
+    return bool(re.match(r'^\d+(\.\d+)*\.?\s+[A-Z][A-Z0-9 ,&/()\-]+$', text))
+
+def build_local_page(record, lines):
+    """Build a LlamaParse-shaped page (page, text, md, items) from pdfminer lines"""
+    sizes = [size for text, size, _ in lines if text and size]
+    body_size = median(sizes) if sizes else 0.0
+
+    items = []
+    paragraph = []
+    for text, size, bold in lines:
+        if not text:
+            continue
+        if is_heading_line(text, size, bold, body_size):
+            if paragraph:
+                items.append({"type": "text", "value": '\n'.join(paragraph)})
+                paragraph = []
+            items.append({"type": "heading", "lvl": 1, "value": text})
+        else:
+            paragraph.append(text)
+    if paragraph:
+        items.append({"type": "text", "value": '\n'.join(paragraph)})
+
+    return {
+        "page": record["page_num"],
+        "text": record["content"],
+        "md": record["content"],
+        "items": items,
+        "extraction": "local"
+    }
+
+def hybrid_extract(pdf_path, parse_pages):
+    """Extract machine-readable pages locally and send only the rest to LlamaParse.
+
+    parse_pages(target_pages) takes 0-based page indexes and returns the
+    LlamaParse pages for them, numbered by their page in the document. The
+    result is one page list, in document order, in the shape match_sections
+    consumes.
+    """
+    pages = {}
+    scanned = []
+    for record, lines in triage_pages(pdf_path):
+        if record["content_type"] == "machine-readable":
+            pages[record["page_num"]] = build_local_page(record, lines)
+        else:
+            scanned.append(record["page_num"])
+
+    logger.info(f"Page triage for {pdf_path}: {len(pages)} machine-readable, {len(scanned)} sent to LlamaParse")
+
+    if scanned:
+        for page in parse_pages([page_num - 1 for page_num in scanned]):
+            pages[page["page"]] = page
+
+    return [pages[page_num] for page_num in sorted(pages)]
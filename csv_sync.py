@@ -0,0 +1,79 @@
+import logging
+from document_builder import extract_pdf_url
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Fields of a stored document that tell whether its CSV row has changed
+SYNC_PROJECTION = {'_id': 0, 'NCT Number': 1, 'Last Update Posted': 1, 'protocol_url': 1, 'pdf_sha256': 1}
+
+def load_synced_studies(collection, batch_size=10000):
+    """{NCT Number: stored sync fields} for every study in MongoDB, from one projected query"""
+    cursor = collection.find({'NCT Number': {'$exists': True}}, SYNC_PROJECTION, batch_size=batch_size)
+    return {document['NCT Number']: document for document in cursor}
+
+def change_reason(row, stored):
+    """Why a CSV row needs processing, or None if the stored document is current"""
+    if stored is None:
+        return "new"
+    protocol_url = extract_pdf_url(row.get('Study Documents', ''))
+    # Documents stored before protocol URLs were recorded are judged by their update date alone
+    if stored.get('protocol_url') and protocol_url != stored['protocol_url']:
+        return "protocol changed"
+    if row.get('Last Update Posted') != stored.get('Last Update Posted'):
+        return "updated"
+    return None
+
+class SyncPlan(object):
+    """Which rows of a ClinicalTrials.gov CSV export differ from what MongoDB holds.
+
+    Rows are new (no document for the NCT Number), have a different
+    protocol URL, or have a different Last Update Posted; everything else is
+    unchanged and skipped. Rows without a protocol PDF that are not stored
+    yet are skipped too, since there is nothing to extract.
+    """
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.pending = {}
+        self.seen = set()
+        self.counts = {"new": 0, "protocol changed": 0, "updated": 0, "unchanged": 0, "no protocol": 0}
+
+    @classmethod
+    def from_csv(cls, csv_rows, stored):
+        plan = cls(stored)
+        for row in csv_rows:
+            plan.add(row)
+        logger.info(f"CSV sync: {plan.counts}; {plan.removed()} stored studies are no longer in the export")
+        return plan
+
+    def add(self, row):
+        nct_number = row.get('NCT Number')
+        reason = change_reason(row, self.stored.get(nct_number))
+        if reason == "new" and not extract_pdf_url(row.get('Study Documents', '')):
+            reason = "no protocol"
+        if reason is None:
+            reason = "unchanged"
+        elif reason != "no protocol":
+            self.pending[nct_number] = reason
+        self.counts[reason] += 1
+        self.seen.add(nct_number)
+        metrics.inc("sync_rows_total", result=reason.replace(" ", "_"))
+
+    def removed(self):
+        """Number of stored studies that are not in the export"""
+        return len(set(self.stored) - self.seen)
+
+    def needs_processing(self, row):
+        return row.get('NCT Number') in self.pending
+
+    def record_stored(self, documents):
+        """Count re-processed studies whose protocol PDF turned out to be unchanged"""
+        unchanged = 0
+        for document in documents:
+            stored = self.stored.get(document.get('NCT Number')) or {}
+            if stored.get('pdf_sha256') and stored['pdf_sha256'] == document.get('pdf_sha256'):
+                unchanged += 1
+        if unchanged:
+            metrics.inc("sync_pdf_unchanged_total", unchanged)
+        return unchanged
@@ -0,0 +1,54 @@
+import os
+import re
+from file_hash import file_sha256
+from section_matcher import match_sections
+
+def get_drug_name(file_path):
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    return base_name.split('_')[0]
+
+def get_protocol_number(content):
+    pattern = r"(?i)protocol\s*number:?\s*([\w-]+)"
+    for page in content:
+        match = re.search(pattern, page['text'])
+        if match:
+            return match.group(1)
+    return "Protocol Number Not Found"
+
+def build_document(file_path, content):
+    matched_sections = match_sections(content, file_path)  # Pass file_path here
+    
+    document = {
+        "drug_name": get_drug_name(file_path),
+        "protocol_source": file_path,
+        "protocol_number": get_protocol_number(content),
+    }
+    document.update(matched_sections)
+    
+    return document
+
+def add_csv_fields(document, row):
+    for key, value in row.items():
+        if key != 'Study Documents':  # Skip this column as we've already processed it
+            document[key] = value
+    return document
+
+def add_protocol_fields(document, pdf_url, pdf_path):
+    """Record where the protocol came from and its PDF hash, for incremental CSV syncs"""
+    document['protocol_url'] = pdf_url
+    document['pdf_sha256'] = file_sha256(pdf_path)
+    return document
+
+def extract_pdf_url(study_documents):
+    # Split the study_documents string by '|' to separate multiple URLs
+    url_parts = study_documents.split('|')
+    
+    # Define the pattern for matching PDF URLs
+    pattern = r'(https?://\S+?(?:Prot_(?:SAP_)?\d+\.pdf))'
+    
+    for part in url_parts:
+        match = re.search(pattern, part.strip(), re.IGNORECASE)
+        if match:
+            return match.group(1)
+    
+    return None
@@ -0,0 +1,164 @@
+import logging
+import os
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying; anything else in the 4xx range is final
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class DownloadError(Exception):
+    """A failed download; permanent when retrying cannot help (no URL, or a final 4xx status)"""
+
+    def __init__(self, message, permanent=False):
+        Exception.__init__(self, message)
+        self.permanent = permanent
+
+class PdfDownloader(object):
+    """Streams protocol PDFs to disk over one connection-pooled session.
+
+    Each download is written in chunks to <file>.part and moved into place
+    with os.replace, so memory stays flat and a half-written file is never
+    mistaken for a finished one. Failed attempts are retried with exponential
+    backoff and resume from the bytes already on disk with an HTTP Range
+    request; chunks are small (64 KB) so that little is lost when a
+    connection drops partway through a protocol. A file already on disk is
+    reused when its size and ETag match what the server reports. A partial
+    file left by an earlier call is only resumed when it has an ETag to send
+    as If-Range, since without one the server cannot tell whether it belongs
+    to the same file.
+    """
+
+    def __init__(self, pool_size=16, timeout=(10, 60), retries=5, backoff_factor=1.0, chunk_size=64 * 1024):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def download(self, url, output_folder):
+        """Download url into output_folder and return the file path"""
+        with metrics.timer("download_seconds"):
+            try:
+                return self._download(url, output_folder)
+            except Exception:
+                metrics.inc("downloads_total", result="error")
+                raise
+
+    def _download(self, url, output_folder):
+        file_name = os.path.basename(urlparse(url).path)
+        file_path = os.path.join(output_folder, file_name)
+
+        if self.is_current(url, file_path):
+            logger.info(f"Using existing download {file_path}")
+            metrics.inc("downloads_total", result="current")
+            return file_path
+
+        part_path = f"{file_path}.part"
+        if os.path.exists(part_path) and not self._read_etag(part_path):
+            # Unvalidated leftover, possibly of another URL with the same file name; start over
+            self._remove(part_path)
+
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, file_path)
+                metrics.inc("downloads_total", result="downloaded")
+                return file_path
+            except DownloadError:
+                raise
+            except (requests.RequestException, IOError) as e:
+                if attempt == self.retries:
+                    raise DownloadError(f"Failed to download {url} after {attempt + 1} attempts: {e}")
+                delay = self.backoff_factor * (2 ** attempt)
+                logger.warning(f"Download of {url} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def is_current(self, url, file_path):
+        """True if file_path already holds the file the server would send"""
+        if not os.path.exists(file_path):
+            return False
+        try:
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        except requests.RequestException:
+            return False
+        if response.status_code != 200:
+            return False
+
+        content_length = response.headers.get('Content-Length')
+        if content_length is None or int(content_length) != os.path.getsize(file_path):
+            return False
+        etag = response.headers.get('ETag')
+        return etag is None or etag == self._read_etag(file_path)
+
+    def _fetch(self, url, file_path):
+        part_path = f"{file_path}.part"
+        headers = {}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        etag = self._read_etag(part_path)
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            if etag:
+                # Only resume if the file has not changed since the partial download
+                headers['If-Range'] = etag
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # Partial file no longer lines up with the server's copy; start over
+                self._remove(part_path)
+                self._remove(self._etag_path(part_path))
+                raise requests.RequestException(f"Range not satisfiable for {url}")
+            if response.status_code in RETRY_STATUSES:
+                raise requests.RequestException(f"HTTP {response.status_code} from {url}")
+            if response.status_code not in (200, 206):
+                raise DownloadError(f"HTTP {response.status_code} from {url}", permanent=400 <= response.status_code < 500)
+
+            if response.status_code == 200:
+                # Server sent the whole file, either because we asked for it or it ignored the range
+                offset = 0
+            etag = response.headers.get('ETag')
+            if etag:
+                self._write_etag(part_path, etag)
+
+            # Content-Length counts encoded bytes, so it can only be checked for identity encoding
+            expected = None if response.headers.get('Content-Encoding') else response.headers.get('Content-Length')
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    metrics.inc("download_bytes_total", len(chunk))
+
+        if expected is not None and os.path.getsize(part_path) != offset + int(expected):
+            raise IOError(f"Incomplete download of {url}")
+
+        os.replace(part_path, file_path)
+        if etag:
+            os.replace(self._etag_path(part_path), self._etag_path(file_path))
+        logger.info(f"Downloaded {url} to {file_path} ({os.path.getsize(file_path)} bytes)")
+
+    @staticmethod
+    def _etag_path(file_path):
+        return f"{file_path}.etag"
+
+    def _read_etag(self, file_path):
+        try:
+            with open(self._etag_path(file_path), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _write_etag(self, file_path, etag):
+        with open(self._etag_path(file_path), 'w') as f:
+            f.write(etag)
+
+    @staticmethod
+    def _remove(file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
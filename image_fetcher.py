@@ -0,0 +1,75 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+def referenced_images(content, sections):
+    """Pick the page images that matched sections refer to.
+
+    Image items carry the LlamaParse image name when there is one; unnamed
+    image items fall back to every image on their page (or, for sections
+    stored before items recorded their page, on the section's pages).
+    Named items are matched together with their page, since image names are
+    only unique within one LlamaParse job and sharded parses have several.
+    Returns (page, image) pairs.
+    """
+    names = set()
+    page_names = set()
+    page_ranges = []
+    for section in sections.values():
+        if not isinstance(section, dict):
+            continue
+        for item in section.get('images', []):
+            if item.get('name') and item.get('page') is not None:
+                page_names.add((item['page'], item['name']))
+            elif item.get('name'):
+                names.add(item['name'])
+            elif item.get('page') is not None:
+                page_ranges.append((item['page'], item['page']))
+            elif section.get('start_page') is not None:
+                page_ranges.append((section['start_page'], max(section['start_page'], section['end_page'])))
+
+    selected = []
+    for page in content:
+        in_range = any(start <= page['page'] <= end for start, end in page_ranges)
+        for image in page.get('images', []):
+            if in_range or image.get('name') in names or (page['page'], image.get('name')) in page_names:
+                selected.append((page, image))
+    return selected
+
+class SectionImageFetcher(object):
+    """Downloads only the images referenced by matched sections, concurrently.
+
+    backend_for_key(index) returns a LlamaParse instance for the API key that
+    parsed the document, since images can only be fetched by the job's owner.
+    """
+
+    def __init__(self, backend_for_key, max_workers=8):
+        self.backend_for_key = backend_for_key
+        self.max_workers = max_workers
+
+    def fetch(self, content, sections, download_path):
+        """Download the referenced images into download_path and return their paths"""
+        selected = referenced_images(content, sections)
+        if not selected:
+            return []
+        os.makedirs(download_path, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda pair: self._fetch_one(pair[0], pair[1], download_path), selected))
+
+        paths = [path for path in results if path]
+        logger.info(f"Downloaded {len(paths)} of {len(selected)} section images to {download_path}")
+        return paths
+
+    def _fetch_one(self, page, image, download_path):
+        backend = self.backend_for_key(page.get('api_key_index') or 0)
+        # Single-image job result so get_images fetches just this file
+        json_result = [{"job_id": page.get('job_id'), "pages": [{"page": page['page'], "images": [image]}]}]
+        try:
+            image_dicts = backend.get_images(json_result, download_path=download_path)
+        except Exception as e:
+            logger.error(f"Error downloading image {image.get('name')} from page {page['page']}: {e}")
+            return None
+        return image_dicts[0]["path"] if image_dicts else None
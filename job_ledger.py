@@ -0,0 +1,118 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Stages a study passes through, in order; "failed" rows keep the stage they reached
+STAGES = ("downloaded", "parsed", "matched", "stored")
+
+class JobLedger(object):
+    """SQLite record of how far each study (by NCT Number) got in a batch run.
+
+    Rows that reached "stored" are skipped on the next run. Failed rows are
+    retried once their backoff has passed, doubling from backoff_base up to
+    backoff_max seconds, and given up after max_attempts failures, or at
+    once for permanent failures such as a missing protocol URL. Updates
+    are committed immediately, so a killed run loses at most the rows that
+    were in flight.
+    """
+
+    def __init__(self, path="job_ledger.db", max_attempts=5, backoff_base=60.0, backoff_max=3600.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                nct_number TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                failed INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                next_attempt REAL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def status(self, nct_number):
+        """Return (stage, failed, attempts, next_attempt) or None for a study not seen before"""
+        rows = self._execute("SELECT stage, failed, attempts, next_attempt FROM jobs WHERE nct_number = ?", (nct_number,))
+        return rows[0] if rows else None
+
+    def should_process(self, nct_number, now=None):
+        status = self.status(nct_number)
+        if status is None:
+            return True
+        stage, failed, attempts, next_attempt = status
+        if not failed:
+            return stage != "stored"
+        if attempts >= self.max_attempts:
+            return False
+        return (next_attempt or 0) <= (now or time.time())
+
+    def mark(self, nct_number, stage):
+        """Record that a study reached stage; clears an earlier failure"""
+        self._execute("""
+            INSERT INTO jobs (nct_number, stage, failed, updated) VALUES (?, ?, 0, ?)
+            ON CONFLICT(nct_number) DO UPDATE SET stage = excluded.stage, failed = 0, error = NULL, updated = excluded.updated
+        """, (nct_number, stage, time.time()))
+        if stage == "stored":
+            self._execute("UPDATE jobs SET attempts = 0, next_attempt = NULL WHERE nct_number = ?", (nct_number,))
+
+    def requeue(self, nct_number):
+        """Make a study due again with a fresh attempt count, e.g. because it changed since it was stored"""
+        self._execute("""
+            UPDATE jobs SET stage = 'new', failed = 0, attempts = 0, error = NULL, next_attempt = NULL, updated = ?
+            WHERE nct_number = ?
+        """, (time.time(), nct_number))
+
+    def fail(self, nct_number, error, permanent=False):
+        """Record a failure and schedule the next attempt; a permanent failure is not retried"""
+        status = self.status(nct_number)
+        attempts = (status[2] if status else 0) + 1
+        now = time.time()
+        if permanent:
+            attempts = max(attempts, self.max_attempts)
+            next_attempt = None
+        else:
+            next_attempt = now + min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        self._execute("""
+            INSERT INTO jobs (nct_number, stage, failed, attempts, error, next_attempt, updated) VALUES (?, 'new', 1, ?, ?, ?, ?)
+            ON CONFLICT(nct_number) DO UPDATE SET failed = 1, attempts = excluded.attempts, error = excluded.error,
+                next_attempt = excluded.next_attempt, updated = excluded.updated
+        """, (nct_number, attempts, str(error), next_attempt, now))
+        if permanent:
+            logger.warning(f"Giving up on {nct_number}, retrying cannot help: {error}")
+        elif attempts >= self.max_attempts:
+            logger.warning(f"Giving up on {nct_number} after {attempts} failed attempts: {error}")
+
+    def next_retry(self):
+        """Earliest time a failed study becomes due again, or None if none will be retried"""
+        rows = self._execute("SELECT MIN(next_attempt) FROM jobs WHERE failed = 1 AND attempts < ?", (self.max_attempts,))
+        return rows[0][0]
+
+    def progress(self):
+        """Counts per stage, with failures counted separately"""
+        counts = {stage: 0 for stage in STAGES}
+        counts["failed"] = 0
+        for stage, failed, count in self._execute("SELECT stage, failed, COUNT(*) FROM jobs GROUP BY stage, failed"):
+            key = "failed" if failed else stage
+            counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def failures(self):
+        """(nct_number, attempts, error) for every failed study"""
+        return self._execute("SELECT nct_number, attempts, error FROM jobs WHERE failed = 1 ORDER BY nct_number")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
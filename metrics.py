@@ -0,0 +1,202 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the timing histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Counters that measure pages, paired with the timing histogram they are rated against
+PAGE_RATES = {
+    "match_pages_total": "match_seconds",
+    "llamaparse_pages_total": "llamaparse_seconds"
+}
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for index, count in enumerate(other["counts"]):
+            self.counts[index] += count
+        self.count += other["count"]
+        self.sum += other["sum"]
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def state(self):
+        return {"counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+class Metrics(object):
+    """Process-wide counters and timing histograms for one run.
+
+    Metrics are identified by name plus keyword labels, the way Prometheus
+    names them. Work done in worker processes is recorded there and merged
+    back with collect()/merge(). Export with write() as a Prometheus textfile
+    (.prom) or a JSON summary.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the duration of the with-block in the named histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Picklable copy of every metric, for merge()"""
+        with self._lock:
+            return {
+                "counters": [(name, labels, value) for (name, labels), value in self.counters.items()],
+                "histograms": [(name, labels, histogram.state()) for (name, labels), histogram in self.histograms.items()]
+            }
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot["counters"]:
+                self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+            for name, labels, state in snapshot["histograms"]:
+                histogram = self.histograms.get((name, labels))
+                if histogram is None:
+                    histogram = self.histograms[(name, labels)] = Histogram()
+                histogram.merge(state)
+
+    def summary(self):
+        """JSON-friendly view: counters, histogram count/sum/mean/p50/p95 and pages per second"""
+        with self._lock:
+            counters = [(name, dict(labels), value) for (name, labels), value in sorted(self.counters.items())]
+            histograms = [(name, dict(labels), histogram) for (name, labels), histogram in sorted(self.histograms.items())]
+            summary = {
+                "started": self.started,
+                "elapsed_s": time.time() - self.started,
+                "counters": [{"name": name, "labels": labels, "value": value} for name, labels, value in counters],
+                "histograms": [{
+                    "name": name,
+                    "labels": labels,
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else None,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95)
+                } for name, labels, histogram in histograms],
+                "pages_per_second": {}
+            }
+            for counter_name, histogram_name in PAGE_RATES.items():
+                pages = sum(value for (name, _), value in self.counters.items() if name == counter_name)
+                seconds = sum(histogram.sum for (name, _), histogram in self.histograms.items() if name == histogram_name)
+                if seconds:
+                    summary["pages_per_second"][histogram_name[:-len("_seconds")]] = pages / seconds
+        return summary
+
+    def prometheus(self, prefix="protocol_extractor_"):
+        """Prometheus text exposition format"""
+        def render_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = ((name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+            return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}{name} counter")
+                    typed.add(name)
+                lines.append(f"{prefix}{name}{render_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}{name}_bucket{render_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{render_labels(labels)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{render_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to path atomically: Prometheus text for .prom files, JSON otherwise"""
+        data = self.prometheus() if path.endswith('.prom') else json.dumps(self.summary(), indent=2)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return path
+
+metrics = Metrics()
+
+def collect(function, *args, **kwargs):
+    """Run function and return (result, snapshot of only what it recorded).
+
+    For work sent to a process pool: the parent merges the snapshot, since
+    metrics recorded in a worker process are otherwise lost. Anything the
+    process recorded before is kept and the new metrics are added to it.
+    """
+    with metrics._lock:
+        saved = metrics.counters, metrics.histograms
+        metrics.counters, metrics.histograms = {}, {}
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        snapshot = metrics.snapshot()
+        with metrics._lock:
+            metrics.counters, metrics.histograms = saved
+        metrics.merge(snapshot)
+    return result, snapshot
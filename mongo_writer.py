@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def collection_from_env():
+    """The protocol collection configured by the MONGO_* environment variables"""
+    mongo_uri = f"mongodb://{os.getenv('MONGO_USERNAME')}:{os.getenv('MONGO_PASSWORD')}@{os.getenv('MONGO_HOST')}:{os.getenv('MONGO_PORT')}/{os.getenv('MONGO_DB')}?authSource=admin"
+    client = MongoClient(mongo_uri)
+    return client[os.getenv('MONGO_DB')][os.getenv('MONGO_COLLECTION')]
+
+def document_key(document):
+    """Filter that identifies a protocol document across runs"""
+    if document.get('NCT Number'):
+        return {'NCT Number': document['NCT Number']}
+    if document.get('protocol_number') and document['protocol_number'] != "Protocol Number Not Found":
+        return {'protocol_number': document['protocol_number']}
+    return {'protocol_source': document['protocol_source']}
+
+class MongoBulkWriter(object):
+    """Buffers protocol documents and upserts them with unordered bulk writes.
+
+    Documents are replaced by NCT Number (or protocol number / source when
+    there is no NCT Number), so re-running a CSV updates documents instead
+    of duplicating them. The buffer is flushed when it reaches batch_size and
+    by a background timer every flush_interval seconds. Failures are reported
+    per document in self.failures as (key, error message); when a whole
+    flush fails (for example the server is unreachable) its documents are
+    dropped and flush() raises, so the caller decides whether to retry them.
+    """
+
+    def __init__(self, collection, batch_size=500, flush_interval=5.0):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {"flushes": 0, "upserted": 0, "modified": 0, "failed": 0}
+        self.failures = []
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = None
+        if flush_interval:
+            self._timer = threading.Thread(target=self._flush_periodically, name="mongo-flush", daemon=True)
+            self._timer.start()
+
+    def add(self, document):
+        key = document_key(document)
+        with self._lock:
+            # A later document for the same study replaces the buffered one
+            self._buffer[tuple(key.items())] = (key, document)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def add_many(self, documents):
+        for document in documents:
+            self.add(document)
+
+    def flush(self):
+        """Write the buffered documents; returns the failures from this flush"""
+        with self._lock:
+            pending = list(self._buffer.values())
+            self._buffer = {}
+        if not pending:
+            return []
+        return self._write(pending)
+
+    def write(self, documents):
+        """Upsert documents now, bypassing the buffer; returns their failures as (key, error).
+
+        Callers that record per-document outcomes (the ledger, the section
+        index) use this, so a timer or batch_size flush cannot write their
+        documents behind their back and swallow the failures.
+        """
+        pending = {}
+        for document in documents:
+            key = document_key(document)
+            pending[tuple(key.items())] = (key, document)
+        if not pending:
+            return []
+        return self._write(list(pending.values()))
+
+    def _write(self, pending):
+        operations = [ReplaceOne(key, document, upsert=True) for key, document in pending]
+        failures = []
+        started = time.perf_counter()
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get('writeErrors', []):
+                key = pending[error['index']][0]
+                failures.append((key, error.get('errmsg')))
+                logger.error(f"Error saving document {key} to MongoDB: {error.get('errmsg')}")
+        except Exception as e:
+            # Nothing was acknowledged. The documents are dropped, not re-buffered: callers record the
+            # whole batch as failed, and a later timer flush must not store rows the ledger will retry
+            failures = [(key, str(e)) for key, _ in pending]
+            with self._lock:
+                self.stats["failed"] += len(failures)
+                self.failures.extend(failures)
+            metrics.inc("mongo_documents_total", len(failures), result="failed")
+            raise
+
+        with self._lock:
+            self.stats["flushes"] += 1
+            self.stats["upserted"] += details.get('nUpserted', 0)
+            self.stats["modified"] += details.get('nModified', 0)
+            self.stats["failed"] += len(failures)
+            self.failures.extend(failures)
+        metrics.observe("mongo_flush_seconds", time.perf_counter() - started)
+        metrics.inc("mongo_documents_total", details.get('nUpserted', 0), result="upserted")
+        metrics.inc("mongo_documents_total", details.get('nModified', 0), result="modified")
+        metrics.inc("mongo_documents_total", len(failures), result="failed")
+        logger.info(f"Flushed {len(operations)} documents to MongoDB "
+                    f"({details.get('nUpserted', 0)} new, {details.get('nModified', 0)} updated, {len(failures)} failed)")
+        return failures
+
+    def close(self):
+        self._closed.set()
+        if self._timer:
+            self._timer.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing documents to MongoDB: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import zlib
+import numpy as np
+from section_model import TEXT, is_matched
+
+logger = logging.getLogger(__name__)
+
+# Paragraphs shorter than this carry too few shingles to compare reliably
+MIN_WORDS = 8
+# Largest prime below 2**61; permuted hashes are taken modulo it
+MERSENNE_PRIME = (1 << 61) - 1
+
+def section_paragraphs(section):
+    """Text paragraphs of a matched section, for compact sections and "content" strings"""
+    if isinstance(section.get('content'), str):
+        paragraphs = section['content'].split('\n\n')
+    else:
+        paragraphs = [ref for kind, ref in section.get('blocks', []) if kind == TEXT]
+    return [paragraph.strip() for paragraph in paragraphs if len(paragraph.split()) >= MIN_WORDS]
+
+def shingle_hashes(text, shingle_size=5):
+    """32-bit hashes of the word shingles of text, as a uint64 array"""
+    tokens = re.findall(r'[a-z0-9]+', text.lower())
+    if not tokens:
+        return np.zeros(1, dtype=np.uint64)
+    token_hashes = np.array([zlib.crc32(token.encode()) for token in tokens], dtype=np.uint64)
+    size = min(shingle_size, len(tokens))
+    # Polynomial hash over each window of size tokens; wraps modulo 2**64, then keeps the low 32 bits
+    shingles = np.zeros(len(tokens) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        shingles = shingles * np.uint64(1000003) + token_hashes[offset:len(tokens) - size + 1 + offset]
+    return np.unique(shingles & np.uint64(0xFFFFFFFF))
+
+class MinHasher(object):
+    """MinHash signatures from num_perm universal hash permutations, all computed at once with numpy"""
+
+    def __init__(self, num_perm=128, seed=1):
+        state = np.random.RandomState(seed)
+        # a, b and the shingle hashes are below 2**32, so a * h + b cannot overflow 64 bits
+        self.a = state.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = state.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, hashes):
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % np.uint64(MERSENNE_PRIME)
+        return permuted.min(axis=1).astype(np.uint32)
+
+class DisjointSet(object):
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parent[max(first, second)] = min(first, second)
+
+class NearDuplicateIndex(object):
+    """Common versus unique paragraphs of each section across protocols.
+
+    Paragraphs of matched sections are shingled into word n-grams and
+    summarised as MinHash signatures, which are stored in SQLite so a
+    protocol is only hashed once; add() skips documents whose sections have
+    not changed. clusters() buckets the stored signatures of a section with
+    LSH banding, confirms candidate pairs by their estimated Jaccard
+    similarity and joins them into clusters, in time roughly linear in the
+    number of paragraphs. A cluster is common when paragraphs from at least
+    min_documents protocols fall into it, unique otherwise.
+    """
+
+    def __init__(self, path="near_duplicates.db", num_perm=128, bands=32, threshold=0.5, shingle_size=5, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.path = path
+        self.bands = bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm, seed)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS paragraphs (
+                id INTEGER PRIMARY KEY,
+                document TEXT NOT NULL,
+                section TEXT NOT NULL,
+                text TEXT NOT NULL,
+                signature BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS paragraphs_document ON paragraphs (document);
+            CREATE INDEX IF NOT EXISTS paragraphs_section ON paragraphs (section);
+        """)
+        self._check_settings({"num_perm": num_perm, "seed": seed, "shingle_size": shingle_size, "min_words": MIN_WORDS})
+
+    def _check_settings(self, settings):
+        """Signatures made with other hashing settings cannot be compared; refuse to mix them"""
+        with self._lock:
+            stored = dict(self._connection.execute("SELECT name, value FROM settings").fetchall())
+            if not stored:
+                self._connection.executemany("INSERT INTO settings (name, value) VALUES (?, ?)",
+                                             [(name, str(value)) for name, value in settings.items()])
+                return
+        changed = {name for name, value in settings.items() if stored.get(name) != str(value)}
+        if changed:
+            raise ValueError(f"{self.path} was built with different {', '.join(sorted(changed))}; delete it to rebuild")
+
+    def add(self, document):
+        """Store the paragraph signatures of one protocol; returns the number hashed (0 if unchanged)"""
+        key = document.get('NCT Number') or document.get('protocol_source')
+        if not key:
+            raise ValueError("Document has neither an NCT Number nor a protocol_source")
+        paragraphs = [(name, paragraph) for name, section in document.items() if is_matched(section)
+                      for paragraph in section_paragraphs(section)]
+        fingerprint = hashlib.sha256('\x00'.join(f"{name}\x01{paragraph}" for name, paragraph in paragraphs).encode()).hexdigest()
+
+        with self._lock:
+            found = self._connection.execute("SELECT fingerprint FROM documents WHERE key = ?", (key,)).fetchone()
+        if found and found[0] == fingerprint:
+            return 0
+
+        rows = [(key, name, paragraph, self.hasher.signature(shingle_hashes(paragraph, self.shingle_size)).tobytes())
+                for name, paragraph in paragraphs]
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                connection.execute("DELETE FROM paragraphs WHERE document = ?", (key,))
+                connection.executemany("INSERT INTO paragraphs (document, section, text, signature) VALUES (?, ?, ?, ?)", rows)
+                connection.execute("INSERT OR REPLACE INTO documents (key, fingerprint) VALUES (?, ?)", (key, fingerprint))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def sections(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT DISTINCT section FROM paragraphs ORDER BY section")]
+
+    def clusters(self, section, min_documents=2, documents=None):
+        """{"common": [...], "unique": [...]} clusters of a section's paragraphs.
+
+        Each cluster has the documents it spans and its paragraphs as
+        (document, text) pairs; common clusters come first by the number of
+        documents they span. documents limits the comparison to those
+        protocol keys, such as a set of precedent protocols.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT document, text, signature FROM paragraphs WHERE section = ? ORDER BY id", (section,)
+            ).fetchall()
+        if documents is not None:
+            documents = set(documents)
+            rows = [row for row in rows if row[0] in documents]
+        if not rows:
+            return {"common": [], "unique": []}
+
+        signatures = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.uint32).reshape(len(rows), -1)
+        groups = DisjointSet(len(rows))
+        rows_per_band = signatures.shape[1] // self.bands
+        checked = set()
+        for band in range(self.bands):
+            band_values = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+            _, bucket_ids, counts = np.unique(band_values, axis=0, return_inverse=True, return_counts=True)
+            order = np.argsort(bucket_ids.reshape(-1), kind='stable')
+            ends = np.cumsum(counts)
+            for bucket in np.flatnonzero(counts > 1):
+                members = order[ends[bucket] - counts[bucket]:ends[bucket]].tolist()
+                # Each member is compared with the bucket's first member and, failing that, its
+                # predecessor, rather than with every member; transitivity joins the rest
+                for position in range(1, len(members)):
+                    other = members[position]
+                    for first in {members[0], members[position - 1]}:
+                        if groups.find(first) == groups.find(other) or (first, other) in checked:
+                            continue
+                        checked.add((first, other))
+                        if np.mean(signatures[first] == signatures[other]) >= self.threshold:
+                            groups.union(first, other)
+
+        members = {}
+        for index in range(len(rows)):
+            members.setdefault(groups.find(index), []).append(index)
+        result = {"common": [], "unique": []}
+        for indexes in members.values():
+            documents = sorted({rows[index][0] for index in indexes})
+            cluster = {
+                "documents": documents,
+                "paragraphs": [(rows[index][0], rows[index][1]) for index in indexes]
+            }
+            result["common" if len(documents) >= min_documents else "unique"].append(cluster)
+        result["common"].sort(key=lambda cluster: -len(cluster["documents"]))
+        return result
+
+    def report(self, sections=None, min_documents=2, documents=None):
+        """Common and unique content per section, with one representative paragraph per cluster"""
+        report = {}
+        for section in sections or self.sections():
+            clusters = self.clusters(section, min_documents, documents)
+            report[section] = {kind: [{
+                "documents": cluster["documents"],
+                "text": cluster["paragraphs"][0][1],
+                "paragraphs": len(cluster["paragraphs"])
+            } for cluster in clusters[kind]] for kind in ("common", "unique")}
+        return report
+
+    def stats(self):
+        with self._lock:
+            documents = self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            paragraphs = self._connection.execute("SELECT COUNT(*) FROM paragraphs").fetchone()[0]
+        return {"documents": documents, "paragraphs": paragraphs}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,85 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, wait
+from pdf_extractor import pages_from_result
+
+logger = logging.getLogger(__name__)
+
+def pdf_page_count(pdf_path):
+    """Page count from the PDF's page tree, or None if the file cannot be read"""
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdftypes import resolve1
+    try:
+        with open(pdf_path, 'rb') as f:
+            document = PDFDocument(PDFParser(f))
+            return int(resolve1(resolve1(document.catalog['Pages'])['Count']))
+    except Exception as e:
+        logger.warning(f"Could not read the page count of {pdf_path}: {e}")
+        return None
+
+def split_pages(page_indexes, shard_size):
+    """Split page indexes into the fewest shards of at most shard_size pages, evenly sized"""
+    page_indexes = list(page_indexes)
+    if not shard_size or len(page_indexes) <= shard_size:
+        return [page_indexes]
+    count = -(-len(page_indexes) // shard_size)
+    size, extra = divmod(len(page_indexes), count)
+    shards = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        shards.append(page_indexes[start:end])
+        start = end
+    return shards
+
+def number_pages(page_indexes, parsed):
+    """Give the pages LlamaParse returned for the 0-based page_indexes their 1-based document page numbers.
+
+    LlamaParse numbers the pages of a target_pages job within the job, so
+    pages are renumbered by position. If it returned a different number of
+    pages than requested, its own numbers are mapped through page_indexes
+    when they look job-relative and kept otherwise.
+    """
+    if len(parsed) == len(page_indexes):
+        for page_index, page in zip(page_indexes, parsed):
+            page["page"] = page_index + 1
+        return parsed
+
+    logger.warning(f"LlamaParse returned {len(parsed)} pages for {len(page_indexes)} requested")
+    if all(1 <= page.get("page", 0) <= len(page_indexes) for page in parsed):
+        for page in parsed:
+            page["page"] = page_indexes[page["page"] - 1] + 1
+    return parsed
+
+def parse_in_shards(parser, pdf_path, page_indexes, shard_size, max_parallel=4):
+    """Parse page_indexes of pdf_path as shards of at most shard_size pages, max_parallel at a time.
+
+    parser is a started AsyncLlamaParser; each shard is its own target_pages
+    job. Every page keeps the job_id and key of the shard that parsed it, so
+    its images are fetched from the right job. Returns all pages in document
+    order with document page numbers; if any shard fails, the rest are
+    cancelled and the error is raised.
+    """
+    shards = split_pages(page_indexes, shard_size)
+    if len(shards) > 1:
+        logger.info(f"Parsing {len(page_indexes)} pages of {pdf_path} as {len(shards)} shards of up to {len(shards[0])} pages")
+
+    results = [None] * len(shards)
+    pending = {}
+    next_shard = 0
+    try:
+        while next_shard < len(shards) or pending:
+            while next_shard < len(shards) and len(pending) < max(1, max_parallel):
+                options = {"target_pages": ",".join(str(page) for page in shards[next_shard])}
+                pending[parser.submit(pdf_path, options, pages=len(shards[next_shard]))] = next_shard
+                next_shard += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                json_objs, key_index = future.result()
+                results[index] = number_pages(shards[index], pages_from_result(json_objs, key_index))
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    return [page for shard in results for page in shard]
@@ -0,0 +1,118 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from functools import lru_cache
+
+# File layout: MAGIC, one zlib-compressed JSON record per page, the
+# compressed JSON index, then the index offset and MAGIC again as a footer
+MAGIC = b"LPPAGES1"
+FOOTER = struct.Struct('<Q')
+COMPRESSION_LEVEL = 6
+# Decoded pages kept per open store; section matching revisits nearby pages
+PAGE_CACHE_SIZE = 64
+
+def encode(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL)
+
+def decode(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def write_pages(path, pages, metadata=None):
+    """Write a page list to path atomically, one compressed record per page.
+
+    The index holds each page's offset and length, its page number and its
+    heading items, so readers can find sections without decoding every page.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            records = []
+            for page in pages:
+                data = encode(page)
+                headings = [(item_idx, item.get('value', '')) for item_idx, item in enumerate(page.get('items', []))
+                            if item.get('type', '').lower() == 'heading']
+                records.append([f.tell(), len(data), page.get('page'), headings])
+                f.write(data)
+            index_offset = f.tell()
+            f.write(encode({"metadata": metadata or {}, "pages": records}))
+            f.write(FOOTER.pack(index_offset))
+            f.write(MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+class PageStore(object):
+    """Read-only, memory-mapped view of a file written by write_pages.
+
+    Behaves like a list of page dicts (len, indexing, slicing, iteration) but
+    decodes a page only when it is accessed. Pickles as its path, so worker
+    processes reopen the file instead of receiving every page.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        footer_start = len(self._map) - FOOTER.size - len(MAGIC)
+        if self._map[:len(MAGIC)] != MAGIC or self._map[footer_start + FOOTER.size:] != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a page store")
+        index_offset, = FOOTER.unpack(self._map[footer_start:footer_start + FOOTER.size])
+        index = decode(self._map[index_offset:footer_start])
+        self.metadata = index["metadata"]
+        self._records = index["pages"]
+        self._page = lru_cache(maxsize=PAGE_CACHE_SIZE)(self._read_page)
+
+    def _read_page(self, page_idx):
+        offset, length = self._records[page_idx][:2]
+        return decode(self._map[offset:offset + length])
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._page(page_idx) for page_idx in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("page index out of range")
+        return self._page(index)
+
+    def __iter__(self):
+        for page_idx in range(len(self)):
+            yield self._page(page_idx)
+
+    def page_numbers(self):
+        return [record[2] for record in self._records]
+
+    def headings(self):
+        """Yield (page_idx, item_idx, page number, heading text) from the index alone"""
+        for page_idx, (_, _, page, headings) in enumerate(self._records):
+            for item_idx, value in headings:
+                yield page_idx, item_idx, page, value
+
+    def close(self):
+        self._page.cache_clear()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
@@ -0,0 +1,139 @@
+import logging
+import os
+import pyarrow as pa
+import pyarrow.dataset as ds
+from document_builder import get_drug_name
+from metrics import metrics
+from section_matcher import alternative_names
+from section_model import HEADING, TABLE, is_matched, section_text, subsection_text
+
+logger = logging.getLogger(__name__)
+
+# Section fields read for each export; images are never needed
+SECTION_FIELDS = ('start_page', 'end_page', 'section_num', 'headings', 'blocks', 'tables', 'subsections', 'content')
+TABLE_FIELDS = ('start_page', 'blocks', 'headings', 'tables')
+DOCUMENT_FIELDS = ('NCT Number', 'drug_name', 'protocol_number', 'protocol_source')
+
+SECTION_SCHEMA = pa.schema([
+    ('nct_number', pa.string()),
+    ('drug_name', pa.string()),
+    ('protocol_number', pa.string()),
+    ('section', pa.string()),
+    ('subsection', pa.string()),
+    ('section_num', pa.string()),
+    ('start_page', pa.int32()),
+    ('end_page', pa.int32()),
+    ('text', pa.string())
+])
+
+TABLE_SCHEMA = pa.schema([
+    ('nct_number', pa.string()),
+    ('drug_name', pa.string()),
+    ('protocol_number', pa.string()),
+    ('section', pa.string()),
+    ('heading', pa.string()),
+    ('table_index', pa.int32()),
+    ('page', pa.int32()),
+    ('markdown', pa.string())
+])
+
+def projection(section_fields, sections=None):
+    """MongoDB projection of the document fields and the given fields of each section"""
+    fields = {'_id': 0}
+    fields.update({name: 1 for name in DOCUMENT_FIELDS})
+    for section in sections or alternative_names:
+        fields.update({f"{section}.{field}": 1 for field in section_fields})
+    return fields
+
+def document_columns(document):
+    drug_name = document.get('drug_name')
+    if not drug_name and document.get('protocol_source'):
+        drug_name = get_drug_name(document['protocol_source'])
+    return {
+        "nct_number": document.get('NCT Number'),
+        "drug_name": drug_name,
+        "protocol_number": document.get('protocol_number')
+    }
+
+def section_rows(document, sections=None):
+    """One row per matched section, plus one per template subsection"""
+    columns = document_columns(document)
+    for name in sections or alternative_names:
+        section = document.get(name)
+        if not is_matched(section):
+            continue
+        row = dict(columns, section=name, section_num=section.get('section_num'),
+                   start_page=section['start_page'], end_page=section['end_page'])
+        yield dict(row, subsection=None, text=section_text(section))
+        for title in section.get('subsections') or {}:
+            yield dict(row, subsection=title, text=subsection_text(section, title))
+
+def table_rows(document, sections=None):
+    """One row per table of a matched section, with the heading it appeared under"""
+    columns = document_columns(document)
+    for name in sections or alternative_names:
+        section = document.get(name)
+        if not is_matched(section):
+            continue
+        tables = section.get('tables') or []
+        headings = section.get('headings') or []
+        heading = None
+        for kind, ref in section.get('blocks') or []:
+            if kind == HEADING:
+                heading = headings[ref]["text"]
+            elif kind == TABLE:
+                table = tables[ref]
+                yield dict(columns, section=name, heading=heading, table_index=ref,
+                           page=table.get('page', section['start_page']), markdown=table.get('md'))
+
+def record_batches(rows, schema, batch_rows):
+    """Group rows into record batches of at most batch_rows, so memory stays bounded"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            yield pa.RecordBatch.from_pylist(batch, schema=schema)
+            batch = []
+    if batch:
+        yield pa.RecordBatch.from_pylist(batch, schema=schema)
+
+def write_rows(rows, schema, output_dir, partition_by, batch_rows):
+    """Write rows as a hive-partitioned Parquet dataset; returns the number of rows"""
+    count = [0]
+
+    def counted():
+        for batch in record_batches(rows, schema, batch_rows):
+            count[0] += batch.num_rows
+            yield batch
+
+    ds.write_dataset(
+        counted(),
+        output_dir,
+        schema=schema,
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([schema.field(name) for name in partition_by]), flavor='hive'),
+        existing_data_behavior='delete_matching',
+        max_rows_per_group=batch_rows
+    )
+    return count[0]
+
+def export_parquet(collection, output_dir, query=None, sections=None, partition_by=('section',), batch_rows=10000, cursor_batch_size=200):
+    """Export the stored documents matching query to <output_dir>/sections and <output_dir>/tables.
+
+    Documents are streamed from MongoDB with projections that leave out the
+    section images (and, for tables, the subsections), flattened into rows
+    and written batch_rows at a time. Partitioning by section lets readers
+    load one section without touching the rest. Returns the row counts.
+    """
+    counts = {}
+    for name, fields, rows, schema in (
+        ("sections", SECTION_FIELDS, section_rows, SECTION_SCHEMA),
+        ("tables", TABLE_FIELDS, table_rows, TABLE_SCHEMA)
+    ):
+        cursor = collection.find(query or {}, projection(fields, sections), batch_size=cursor_batch_size)
+        flattened = (row for document in cursor for row in rows(document, sections))
+        with metrics.timer("export_seconds", dataset=name):
+            counts[name] = write_rows(flattened, schema, os.path.join(output_dir, name), partition_by, batch_rows)
+        metrics.inc("export_rows_total", counts[name], dataset=name)
+        logger.info(f"Exported {counts[name]} {name} rows to {os.path.join(output_dir, name)}")
+    return counts
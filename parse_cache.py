@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from file_hash import file_sha256
+from page_store import PageStore, write_pages
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def settings_hash(settings):
+    """Hash parser settings (including the parsing instruction) into a stable key part"""
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+class ParseCache(object):
+    """Local cache of LlamaParse output keyed by PDF content and parser settings.
+
+    Entries are page stores named <sha256 of the PDF>_<hash of the
+    settings>.pages, so the same bytes under a different file name are a hit
+    and a changed parsing instruction is a miss. Hits are returned as lazy
+    PageStore views rather than loaded page lists. Writes go through a temp
+    file and os.replace, and the least recently used entries are evicted once
+    the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir="parse_cache", max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, pdf_path, settings):
+        return f"{file_sha256(pdf_path)}_{settings_hash(settings)[:16]}"
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pages")
+
+    def get(self, key):
+        """Return the cached pages for key as a PageStore, or None on a miss"""
+        cache_path = self.path(key)
+        try:
+            pages = PageStore(cache_path)
+            # Bump the modification time so eviction sees this entry as recently used
+            os.utime(cache_path)
+        except (FileNotFoundError, ValueError):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return pages
+
+    def put(self, key, pages, source=None):
+        """Write the entry for key and return it as a PageStore.
+
+        The store is opened before evicting and key itself is never
+        evicted, so an entry larger than max_bytes is still returned.
+        """
+        write_pages(self.path(key), pages, metadata={"key": key, "source": source})
+        self._count("writes")
+        stored = PageStore(self.path(key))
+        self.evict(keep=key)
+        return stored
+
+    def get_or_create(self, key, create, source=None):
+        """Return the cached pages for key, calling create() to fill a miss.
+
+        Concurrent callers with the same key wait for the first one instead
+        of parsing the same document twice.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            pages = self.get(key)
+            if pages is None:
+                pages = self.put(key, create(), source=source)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return pages
+
+    def entries(self):
+        """Yield (key, source, pages) for every cached parse, pages as a PageStore"""
+        for file_name in sorted(os.listdir(self.cache_dir)):
+            if not file_name.endswith('.pages'):
+                continue
+            try:
+                pages = PageStore(os.path.join(self.cache_dir, file_name))
+            except (FileNotFoundError, ValueError):
+                continue
+            yield pages.metadata.get("key", file_name[:-len('.pages')]), pages.metadata.get("source"), pages
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes.
+
+        keep and the entries get_or_create() is still filling are never
+        removed, so another thread's entry cannot vanish between being
+        written and being opened.
+        """
+        with self._lock:
+            kept = set(self._key_locks)
+        if keep is not None:
+            kept.add(keep)
+        files = []
+        total = 0
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.pages'):
+                continue
+            if os.path.splitext(file_name)[0] in kept:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_name))
+            total += stat.st_size
+
+        for _, size, file_name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except OSError:
+                # Already evicted by another thread, or still mapped by a reader on Windows
+                continue
+            total -= size
+            self._count("evictions")
+            logger.info(f"Evicted {file_name} from parse cache")
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+        metrics.inc("parse_cache_events_total", event=key)
@@ -0,0 +1,84 @@
+import itertools
+import logging
+import os
+import queue
+import time
+from functools import lru_cache
+from page_shards import pdf_page_count
+
+logger = logging.getLogger(__name__)
+
+# Rough size of one protocol page, used when the page count cannot be read
+PAGE_BYTES_ESTIMATE = 60 * 1024
+# Each job queued later ranks this many pages behind, so large jobs wait for a bounded number of smaller ones
+AGING_PAGES = 10
+
+@lru_cache(maxsize=4096)
+def _page_count(pdf_path, size, mtime):
+    return pdf_page_count(pdf_path)
+
+def exact_page_count(pdf_path):
+    """Page count from the PDF's page tree, or None if it cannot be read.
+
+    Only the trailer, cross-reference table and catalog are read, not the
+    page content; results are cached by path, size and modification time.
+    """
+    stat = os.stat(pdf_path)
+    return _page_count(pdf_path, stat.st_size, stat.st_mtime)
+
+def document_pages(pdf_path):
+    """exact_page_count(), or an estimate from the file size if that cannot be read.
+
+    Only good for ordering and budgeting jobs; decide which pages to parse
+    from exact_page_count() alone.
+    """
+    pages = exact_page_count(pdf_path)
+    if pages is None:
+        pages = max(1, os.path.getsize(pdf_path) // PAGE_BYTES_ESTIMATE)
+        logger.debug(f"Estimated {pages} pages for {pdf_path} from its size")
+    return pages
+
+def job_rank(pages, sequence, aging_pages=AGING_PAGES):
+    """Scheduling rank of a job of pages queued sequence-th; lower runs first"""
+    return (pages or 0) + sequence * aging_pages
+
+class ShortestFirstQueue(queue.PriorityQueue):
+    """Bounded queue that hands out the cheapest item first, ranked by job_rank().
+
+    cost(item) gives an item's size in pages. Aging keeps large items from
+    waiting forever: one queued k items later than another ranks
+    k * aging_pages behind it, so a 600-page protocol is overtaken by at
+    most 600 / aging_pages smaller ones. Items cost() marks as None (such as
+    end-of-stream markers) always come out last. cost() runs in put(),
+    before the queue lock is taken, so slow sizing never blocks get().
+    """
+
+    def __init__(self, maxsize, cost, aging_pages=AGING_PAGES):
+        queue.PriorityQueue.__init__(self, maxsize)
+        self.cost = cost
+        self.aging_pages = aging_pages
+        self.sequence = itertools.count()
+        self.pages = 0
+        self.largest_wait = 0.0
+
+    def put(self, item, block=True, timeout=None):
+        queue.PriorityQueue.put(self, (self.cost(item), item), block, timeout)
+
+    def _put(self, entry):
+        pages, item = entry
+        sequence = next(self.sequence)
+        rank = float('inf') if pages is None else job_rank(pages, sequence, self.aging_pages)
+        self.pages += pages or 0
+        queue.PriorityQueue._put(self, (rank, sequence, pages, time.monotonic(), item))
+
+    def _get(self):
+        _, _, pages, queued, item = queue.PriorityQueue._get(self)
+        self.pages -= pages or 0
+        if pages is not None:
+            self.largest_wait = max(self.largest_wait, time.monotonic() - queued)
+        return item
+
+    def stats(self):
+        """Items and pages waiting, and the longest any item has waited so far"""
+        with self.mutex:
+            return {"waiting": len(self.queue), "waiting_pages": self.pages, "largest_wait": round(self.largest_wait, 1)}
@@ -1,33 +1,51 @@
-from llama_parse import LlamaParse
-from llama_index.core.schema import ImageDocument
 from typing import List
 from prompts import ins
-import json
-import nest_asyncio
+from page_store import write_pages
+from metrics import metrics
 import os
 from dotenv import load_dotenv
 load_dotenv()
-nest_asyncio.apply()
+
+# Everything except the API key that shapes the LlamaParse output; also part
+# of the parse cache key, so changing the instruction invalidates old parses
+PARSER_SETTINGS = {
+    "verbose": True,
+    "ignore_errors": False,
+    "invalidate_cache": True,
+    "do_not_cache": True,
+    "parsing_instruction": ins
+}
+
+def get_api_keys():
+    return [
+        os.getenv("LLAMA_CLOUD_API_KEY_1"),
+        os.getenv("LLAMA_CLOUD_API_KEY_2"),
+        os.getenv("LLAMA_CLOUD_API_KEY_3")
+    ]
+
+def create_llamaparse(api_key, **overrides):
+    # llama_parse and its patched event loop are only loaded once a parser is needed
+    import nest_asyncio
+    from llama_parse import LlamaParse
+    nest_asyncio.apply()
+    return LlamaParse(api_key=api_key, **dict(PARSER_SETTINGS, **overrides))
+
+def pages_from_result(json_objs: List[dict], api_key_index: int):
+    """Return the parsed pages, tagged with the job and key needed to fetch their images later"""
+    result = json_objs[0]
+    for page in result["pages"]:
+        page["job_id"] = result.get("job_id")
+        page["api_key_index"] = api_key_index
+    return result["pages"]
 
 class llama_document_parser(object):
     def __init__(self):  # Remove the parsing_ins parameter
-        self.api_keys = [
-            os.getenv("LLAMA_CLOUD_API_KEY_1"),
-            os.getenv("LLAMA_CLOUD_API_KEY_2"),
-            os.getenv("LLAMA_CLOUD_API_KEY_3")
-        ]
+        self.api_keys = get_api_keys()
         self.current_key_index = 0
         self.initialize_parser()
 
     def initialize_parser(self):
-        self.parser = LlamaParse(
-            api_key=self.api_keys[self.current_key_index],
-            verbose=True,
-            ignore_errors=False,
-            invalidate_cache=True,
-            do_not_cache=True,
-            parsing_instruction=ins
-        )
+        self.parser = create_llamaparse(self.api_keys[self.current_key_index])
 
     def switch_api_key(self):
         self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
@@ -36,6 +54,7 @@ class llama_document_parser(object):
 
     def get_image_text_nodes(self, download_path: str, json_objs: List[dict]):
         """Extract out text from images using a multimodal model."""
+        from llama_index.core.schema import ImageDocument
         image_dicts = self.parser.get_images(json_objs, download_path=download_path)
         image_documents = []
         img_text_nodes = []
@@ -44,19 +63,22 @@ class llama_document_parser(object):
             img_text_nodes.append(image_doc)
         return img_text_nodes
 
-    def document_processing_llamaparse(self, file_name: str, image_output_folder: str):
+    def document_processing_llamaparse(self, file_name: str, image_output_folder: str, fetch_images: bool = False):
         """Parse document using llamaparse and return extracted elements in json format"""
         for _ in range(len(self.api_keys)):
             try:
-                json_objs = self.parser.get_json_result(file_name)
-                json_list = json_objs[0]["pages"]
-                print(json_list)
-                if not os.path.exists(image_output_folder):
-                    os.mkdir(image_output_folder)
-
-                image_text_nodes = self.get_image_text_nodes(image_output_folder, json_objs)
+                with metrics.timer("llamaparse_seconds", key=self.current_key_index + 1):
+                    json_objs = self.parser.get_json_result(file_name)
+                json_list = pages_from_result(json_objs, self.current_key_index)
+                metrics.inc("llamaparse_jobs_total", key=self.current_key_index + 1, result="ok")
+                metrics.inc("llamaparse_pages_total", len(json_list), key=self.current_key_index + 1)
+                if fetch_images:
+                    if not os.path.exists(image_output_folder):
+                        os.mkdir(image_output_folder)
+                    image_text_nodes = self.get_image_text_nodes(image_output_folder, json_objs)
                 return json_list
             except Exception as e:
+                metrics.inc("llamaparse_jobs_total", key=self.current_key_index + 1, result="error")
                 print(f"Error with current API key: {str(e)}")
                 self.switch_api_key()
         
@@ -77,10 +99,13 @@ class llama_document_parser(object):
             image_output_folder=os.path.join(output_folder, f"{pdf_name}_images")
         )
 
-        # Save the output as JSON
-        output_path = os.path.join(output_folder, f"{pdf_name}_output.json")
-        with open(output_path, 'w') as f:
-            json.dump(json_list, f, indent=2)
+        return self.save_output(json_list, pdf_path, output_folder)
+
+    @staticmethod
+    def save_output(json_list: List[dict], pdf_path: str, output_folder: str):
+        """Save the parsed pages next to the extracted images as a page store"""
+        pdf_name = os.path.basename(pdf_path).split('.')[0]
+        output_path = write_pages(os.path.join(output_folder, f"{pdf_name}_output.pages"), json_list)
 
         print(f"Output saved to: {output_path}")
-        return json_list
\ No newline at end of file
+        return json_list
@@ -0,0 +1,182 @@
+"""Re-run section matching over every cached parse and update MongoDB in place.
+
+Usage:
+    python clinical_trail_extracter.py rematch [--cache-dir parse_cache] [--legacy-dir protocol_images]
+                                               [--workers N] [--batch-size 200] [--report rematch_report.json]
+                                               [--section-index section_index.db] [--dry-run]
+
+(`python rematch.py ...` is the same command.)
+
+Only the section fields of existing documents are replaced, so no PDF is
+downloaded or parsed again. Cache entries are keyed by the PDF's sha256, and
+every document recording that pdf_sha256 is updated: studies often share a
+file name (Prot_000.pdf), never a hash. Documents stored before pdf_sha256
+was recorded are matched against the <file name>_output.json parses the
+extracter used to write to protocol_images, by the file name of their
+protocol_source; a parse whose file name several documents share is
+skipped, since the old downloads overwrote each other and it cannot tell
+whose protocol it holds. Each run writes per-section hit rates to the report
+file and prints how they changed since the previous report. The sections
+are also replaced in the section full-text index, if there is one.
+"""
+import json
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pymongo import UpdateMany
+from batch_pipeline import worker_context
+from mongo_writer import collection_from_env
+from page_store import PageStore
+from parse_cache import ParseCache
+from section_matcher import alternative_names, match_sections
+from section_index import SectionIndex
+from section_model import is_matched
+
+logger = logging.getLogger(__name__)
+
+def cached_parses(cache):
+    """(document filter, source PDF path, page store path) per PDF, keeping the newest parse of each"""
+    newest = {}
+    for key, source, pages in cache.entries():
+        # Cache keys are <sha256 of the PDF>_<hash of the parser settings>
+        pdf_hash = key.split('_')[0]
+        modified = os.path.getmtime(pages.path)
+        if pdf_hash not in newest or modified > newest[pdf_hash][0]:
+            newest[pdf_hash] = (modified, source, pages.path)
+        pages.close()
+    return [({'pdf_sha256': pdf_hash}, source, path) for pdf_hash, (_, source, path) in sorted(newest.items())]
+
+def legacy_parses(folder, collection=None):
+    """(document filter, source PDF path, JSON path) per <file name>_output.json parse in folder.
+
+    With a collection, a parse is tied to the document whose protocol_source
+    has that file name if it is the only one and has no pdf_sha256 yet;
+    other parses are left out. Without one (a dry run) every parse is
+    listed with no filter.
+    """
+    if not folder or not os.path.isdir(folder):
+        return []
+    entries = []
+    skipped = 0
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('_output.json'):
+            continue
+        path = os.path.join(folder, name)
+        pdf_name = name[:-len('_output.json')]
+        if collection is None:
+            entries.append((None, None, path))
+            continue
+        documents = list(collection.find(
+            {'protocol_source': {'$regex': f"(^|[/\\\\]){re.escape(pdf_name)}\\.pdf$"}},
+            {'_id': 1, 'protocol_source': 1, 'pdf_sha256': 1},
+            limit=2))
+        if len(documents) == 1 and 'pdf_sha256' not in documents[0]:
+            entries.append(({'_id': documents[0]['_id']}, documents[0]['protocol_source'], path))
+        else:
+            skipped += 1
+            logger.debug(f"Skipping {path}: not the only document with this file name, or already re-ingested")
+    if skipped:
+        logger.warning(f"Skipped {skipped} parses in {folder} that no single document without pdf_sha256 matches by file name")
+    return entries
+
+def rematch_entry(entry):
+    """Match one cached parse; runs in a worker process"""
+    target, source, pages_path = entry
+    # The PDF is usually cleaned up after ingest; pdfminer is only needed when pages lack text
+    source = source if source and os.path.exists(source) else None
+    if pages_path.endswith('.json'):
+        with open(pages_path, 'r') as f:
+            return target, match_sections(json.load(f), source)
+    with PageStore(pages_path) as pages:
+        return target, match_sections(pages, source)
+
+def hit_rates(matched_counts, documents):
+    return {section: matched_counts[section] / documents if documents else 0.0 for section in alternative_names}
+
+def write_sections(collection, updates):
+    """Replace the section fields of the documents each update's filter selects; returns how many matched"""
+    operations = [UpdateMany(target, {'$set': sections}) for target, sections in updates]
+    result = collection.bulk_write(operations, ordered=False)
+    return result.matched_count
+
+def index_sections(collection, section_index, updates):
+    """Replace the indexed sections of every study that was re-matched"""
+    documents = []
+    for target, sections in updates:
+        stored = collection.find(target, {'_id': 0, 'NCT Number': 1, 'pdf_sha256': 1, 'protocol_source': 1})
+        documents.extend(dict(sections, **document) for document in stored)
+    section_index.replace_many(documents)
+
+def rematch(cache, collection=None, workers=None, batch_size=200, section_index=None, legacy_dir=None):
+    """Re-match every cached parse; returns (parses, per-section matched counts, documents updated in MongoDB)"""
+    entries = cached_parses(cache) + legacy_parses(legacy_dir, collection)
+    logger.info(f"Re-matching {len(entries)} cached parses")
+    matched_counts = {section: 0 for section in alternative_names}
+    found = 0
+    pending = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context()) as executor:
+        for done, (target, sections) in enumerate(executor.map(rematch_entry, entries, chunksize=4), start=1):
+            for section, value in sections.items():
+                if is_matched(value):
+                    matched_counts[section] += 1
+            pending.append((target, sections))
+            if len(pending) >= batch_size or done == len(entries):
+                if collection is not None:
+                    found += write_sections(collection, pending)
+                    if section_index is not None:
+                        index_sections(collection, section_index, pending)
+                pending = []
+                logger.info(f"Re-matched {done}/{len(entries)} documents")
+    return len(entries), matched_counts, found
+
+def print_hit_rates(current, previous):
+    print(f"{'section':<60} {'previous':>9} {'current':>9} {'change':>8}")
+    for section, rate in current.items():
+        before = previous.get(section)
+        change = f"{(rate - before) * 100:+7.1f}%" if before is not None else ""
+        before_text = f"{before * 100:8.1f}%" if before is not None else f"{'-':>9}"
+        print(f"{section[:60]:<60} {before_text} {rate * 100:8.1f}% {change:>8}")
+
+def run_rematch(cache_dir, legacy_dir="protocol_images", workers=None, batch_size=200,
+                report="rematch_report.json", section_index_path=None, dry_run=False):
+    """Re-match the cached parses, update MongoDB and the section index, and report the hit rates"""
+    # Per-section match logging would drown the progress lines
+    logging.getLogger('section_matcher').setLevel(logging.ERROR)
+    collection = None if dry_run else collection_from_env()
+    section_index = None
+    if not dry_run and section_index_path and os.path.exists(section_index_path):
+        section_index = SectionIndex(section_index_path)
+    documents, matched_counts, found = rematch(ParseCache(cache_dir), collection, workers, batch_size,
+                                               section_index, legacy_dir)
+    if collection is not None:
+        logger.info(f"Updated {found} documents in MongoDB from {documents} cached parses")
+        unhashed = collection.count_documents({'pdf_sha256': {'$exists': False}})
+        if unhashed:
+            logger.warning(f"{unhashed} documents have no pdf_sha256; those without a parse in {legacy_dir} "
+                           f"were not re-matched, re-ingest them to record it")
+
+    previous = {}
+    if os.path.exists(report):
+        with open(report, 'r') as f:
+            previous = json.load(f).get("hit_rates", {})
+    current = hit_rates(matched_counts, documents)
+    print_hit_rates(current, previous)
+
+    with open(report, 'w') as f:
+        json.dump({
+            "created": datetime.now().isoformat(),
+            "documents": documents,
+            "matched": matched_counts,
+            "hit_rates": current
+        }, f, indent=2)
+    return current
+
+def main():
+    from clinical_trail_extracter import main as cli_main
+    cli_main(['rematch'] + sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
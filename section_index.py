@@ -0,0 +1,166 @@
+import logging
+import sqlite3
+import threading
+import time
+from section_model import is_matched, section_text, subsection_text
+
+logger = logging.getLogger(__name__)
+
+# Relative BM25 weight of the section title, subsection title and body columns
+TITLE_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+# Tokens of context on either side of the matches in a snippet
+SNIPPET_TOKENS = 24
+
+class SectionIndex(object):
+    """SQLite FTS5 full-text index of matched sections and subsections.
+
+    Every section and template subsection of a document is one row, keyed by
+    NCT Number (or the PDF's sha256 when there is none), section, subsection
+    and page span. replace() swaps out all rows of a document, so re-ingested
+    and re-matched documents are updated in place. Rows are never replaced
+    by protocol source, whose file name many studies share (Prot_000.pdf).
+    search() ranks rows with BM25, weighting title matches above body
+    matches, and returns snippets.
+    """
+
+    def __init__(self, path="section_index.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sections (
+                id INTEGER PRIMARY KEY,
+                nct_number TEXT,
+                pdf_sha256 TEXT,
+                source TEXT,
+                section TEXT NOT NULL,
+                subsection TEXT,
+                start_page INTEGER,
+                end_page INTEGER,
+                body TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sections_nct_number ON sections (nct_number);
+            CREATE INDEX IF NOT EXISTS sections_pdf_sha256 ON sections (pdf_sha256);
+            CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5(
+                section, subsection, body,
+                content='sections', content_rowid='id', tokenize='porter unicode61'
+            );
+            CREATE TRIGGER IF NOT EXISTS sections_insert AFTER INSERT ON sections BEGIN
+                INSERT INTO sections_fts (rowid, section, subsection, body)
+                VALUES (new.id, new.section, new.subsection, new.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS sections_delete AFTER DELETE ON sections BEGIN
+                INSERT INTO sections_fts (sections_fts, rowid, section, subsection, body)
+                VALUES ('delete', old.id, old.section, old.subsection, old.body);
+            END;
+        """)
+
+    def replace(self, document):
+        """Index the sections of one document in place of its earlier rows; returns the row count"""
+        nct_number = document.get('NCT Number')
+        pdf_hash = document.get('pdf_sha256')
+        source = document.get('protocol_source')
+        if not nct_number and not pdf_hash:
+            raise ValueError(f"Document {source} has neither an NCT Number nor a pdf_sha256")
+
+        rows = []
+        now = time.time()
+        for name, section in document.items():
+            if not is_matched(section):
+                continue
+            body = section_text(section)
+            if body:
+                rows.append((name, None, section['start_page'], section['end_page'], body))
+            for title in section.get('subsections', {}):
+                body = subsection_text(section, title)
+                if body:
+                    rows.append((name, title, section['start_page'], section['end_page'], body))
+
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                if nct_number:
+                    connection.execute("DELETE FROM sections WHERE nct_number = ?", (nct_number,))
+                else:
+                    connection.execute("DELETE FROM sections WHERE pdf_sha256 = ? AND nct_number IS NULL", (pdf_hash,))
+                connection.executemany("""
+                    INSERT INTO sections (nct_number, pdf_sha256, source, section, subsection, start_page, end_page, body, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(nct_number, pdf_hash, source) + row + (now,) for row in rows])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def replace_many(self, documents):
+        """Index a batch; returns (key, error) for the documents that could not be indexed"""
+        failures = []
+        for document in documents:
+            try:
+                self.replace(document)
+            except Exception as e:
+                key = document.get('NCT Number') or document.get('pdf_sha256') or document.get('protocol_source')
+                logger.error(f"Error indexing sections of {key}: {e}")
+                failures.append((key, str(e)))
+        return failures
+
+    def remove(self, nct_number):
+        with self._lock:
+            self._connection.execute("DELETE FROM sections WHERE nct_number = ?", (nct_number,))
+
+    def search(self, query, section=None, limit=20):
+        """Best matching sections for an FTS5 query, optionally only those named section.
+
+        section matches either the main section or the subsection title.
+        Queries that are not valid FTS5 syntax (such as "inclusion-criteria")
+        are retried with every word quoted. Returns dicts with nct_number,
+        source, section, subsection, start_page, end_page, score and snippet;
+        lower scores rank higher, as with SQLite's bm25().
+        """
+        try:
+            return self._search(query, section, limit)
+        except sqlite3.OperationalError:
+            quoted = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+            if quoted == query:
+                raise
+            return self._search(quoted, section, limit)
+
+    def _search(self, query, section, limit):
+        sql = f"""
+            SELECT s.nct_number, s.source, s.section, s.subsection, s.start_page, s.end_page,
+                   bm25(sections_fts, {TITLE_WEIGHT}, {TITLE_WEIGHT}, {BODY_WEIGHT}) AS score,
+                   snippet(sections_fts, 2, '[', ']', '...', {SNIPPET_TOKENS})
+            FROM sections_fts JOIN sections s ON s.id = sections_fts.rowid
+            WHERE sections_fts MATCH ?
+        """
+        parameters = [query]
+        if section:
+            sql += " AND (s.section = ? COLLATE NOCASE OR s.subsection = ? COLLATE NOCASE)"
+            parameters += [section, section]
+        sql += " ORDER BY score LIMIT ?"
+        parameters.append(limit)
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        columns = ("nct_number", "source", "section", "subsection", "start_page", "end_page", "score", "snippet")
+        return [dict(zip(columns, row)) for row in rows]
+
+    def stats(self):
+        with self._lock:
+            documents, rows = self._connection.execute(
+                "SELECT COUNT(DISTINCT COALESCE(nct_number, pdf_sha256, source)), COUNT(*) FROM sections"
+            ).fetchone()
+        return {"documents": documents, "rows": rows}
+
+    def optimize(self):
+        """Merge the FTS5 index segments; worth running after a large ingest"""
+        with self._lock:
+            self._connection.execute("INSERT INTO sections_fts (sections_fts) VALUES ('optimize')")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
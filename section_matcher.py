@@ -1,14 +1,20 @@
 import logging
 import re
 import json
+from bisect import bisect_left
+from collections import Counter, namedtuple
 from difflib import SequenceMatcher
+from functools import lru_cache
 from datetime import datetime
 from io import StringIO
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer, LTChar
+from file_hash import file_sha256
+from page_store import PageStore
+from metrics import metrics
+from toc_parser import TocLocator, printed_page_offset
+from subsection_extractor import get_subsection_extractor
+from section_model import SectionBuilder, empty_section
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Logging is configured by the entry point, not on import
 logger = logging.getLogger(__name__)
 
 # Define alternative section names
@@ -27,16 +33,110 @@ alternative_names = {
     "appendix: adverse events and serious adverse events – definitions, severity, and causality": ["adverse events", "appendix"]
 }
 
+# Only the front matter is searched for a table of contents
+TOC_SEARCH_PAGES = 30
+
+# TOC pages found by pdfminer, keyed by SHA-256 of the PDF
+toc_page_cache = {}
+
+# How far from the TOC's page number a section heading is still accepted,
+# with and without a "Page N of M" footer to calibrate printed page numbers
+TOC_PAGE_SLACK = 3
+TOC_PAGE_SLACK_UNCALIBRATED = 10
+
+# Position of a heading item inside the LlamaParse page/item list
+HeadingEntry = namedtuple('HeadingEntry', ['page_idx', 'item_idx', 'page', 'section_num', 'text', 'value'])
+
 def similarity(a, b):
     return SequenceMatcher(None, a.lower(), b.lower()).ratio()
 
+class HeadingMatcher(object):
+    """Fuzzy heading matcher compiled once from alternative_names.
+
+    Gives the same answers as comparing every heading against the target and
+    its alternative names with similarity() > threshold, but keeps one
+    SequenceMatcher per name (difflib caches its analysis of the second
+    sequence), rejects pairs whose length or character counts cannot reach
+    the threshold before computing the exact ratio, and memoizes the result
+    per normalized heading. Not safe to share between threads.
+    """
+
+    def __init__(self, alternative_names, threshold=0.8, cache_size=8192):
+        self.threshold = threshold
+        self.candidates = {}
+        for target, alt_names in alternative_names.items():
+            self.candidates[target] = [self._compile(name) for name in [target] + list(alt_names)]
+        self.match_normalized = lru_cache(maxsize=cache_size)(self._match_normalized)
+        self._heading_profile = lru_cache(maxsize=cache_size)(self._build_heading_profile)
+
+    @staticmethod
+    def _compile(name):
+        lowered = name.lower()
+        matcher = SequenceMatcher(None)
+        matcher.set_seq2(lowered)
+        return name, lowered, matcher, Counter(lowered)
+
+    @staticmethod
+    def _build_heading_profile(cleaned_heading):
+        return Counter(cleaned_heading)
+
+    def _ratio_bound(self, matches, length):
+        # Same arithmetic as SequenceMatcher.ratio(), so the bound compares exactly
+        return 2.0 * matches / length if length else 1.0
+
+    def _similar(self, cleaned_heading, lowered, matcher, name_counts):
+        length = len(cleaned_heading) + len(lowered)
+        # Length bound: the matching blocks can never cover more than the shorter string
+        if self._ratio_bound(min(len(cleaned_heading), len(lowered)), length) <= self.threshold:
+            return False
+        # Character bound: no more matches than shared characters
+        heading_counts = self._heading_profile(cleaned_heading)
+        shared = sum(min(count, name_counts[char]) for char, count in heading_counts.items())
+        if self._ratio_bound(shared, length) <= self.threshold:
+            return False
+        matcher.set_seq1(cleaned_heading)
+        return matcher.ratio() > self.threshold
+
+    def _match_normalized(self, cleaned_heading, target):
+        for name, lowered, matcher, name_counts in self.candidates.get(target, []):
+            if cleaned_heading == lowered or self._similar(cleaned_heading, lowered, matcher, name_counts):
+                return name
+        return None
+
+    def match(self, heading, target):
+        """Return the target or alternative name the heading matches, or None"""
+        return self.match_normalized(normalize_heading(heading), target)
+
+default_heading_matcher = HeadingMatcher(alternative_names)
+
+def get_heading_matcher(names):
+    if names is alternative_names:
+        return default_heading_matcher
+    return HeadingMatcher(names)
+
 def match_sections(content, pdf_path):
+    with metrics.timer("match_seconds"):
+        matched_sections = find_sections(content, pdf_path)
+    metrics.inc("match_pages_total", len(content))
+    for section, value in matched_sections.items():
+        metrics.inc("sections_total", section=section, result="matched" if value['start_page'] is not None else "missed")
+    return matched_sections
+
+def find_sections(content, pdf_path):
     logger.info("Starting section matching process")
     matched_sections = {}
     last_matched_page = -1
     
-    # Identify TOC pages using pdfminer
-    toc_pages = identify_toc_pages_pdfminer(pdf_path)
+    # Identify TOC pages from the parsed text (pdfminer only as a fallback)
+    toc_pages = set(identify_toc_pages(content, pdf_path))
+    
+    # Walk the page/item list once and index every heading
+    heading_index = build_heading_index(content)
+    heading_pages = [entry.page_idx for entry in heading_index]
+    
+    # Sections listed in the TOC are looked up directly by page range
+    toc_locator = TocLocator.from_pages(content, toc_pages, lambda title, target: match_heading(title, target, alternative_names))
+    page_offset = printed_page_offset(content)
     
     # Define the order of sections to search for
     section_order = list(alternative_names.keys())
@@ -44,24 +144,31 @@ def match_sections(content, pdf_path):
     for main_section in section_order:
         logger.debug(f"Matching main section: '{main_section}'")
         main_section_content = None
-        section_found = False
         
-        for page_num in range(last_matched_page + 1, len(content)):
-            if page_num + 1 in toc_pages:  # Add 1 because pdfminer uses 1-based page numbers
-                continue  # Skip TOC pages
+        first_heading, toc_entry = locate_section_heading(heading_index, heading_pages, toc_locator, toc_pages, page_offset, main_section, alternative_names)
+        if first_heading is not None:
+            main_section_content, end_reason = extract_section_from_index(content, heading_index, first_heading, main_section, alternative_names)
+            metrics.inc("section_lookups_total", method="toc")
+            # Later TOC lookups use the offset between printed and PDF page numbers seen here
+            page_offset = heading_index[first_heading].page - toc_entry.page_number
+        else:
+            # Not in the TOC: scan forward from the first page after the previous
+            # match that is not a TOC page (add 1 because pdfminer uses 1-based page numbers)
+            search_page = next((page_num for page_num in range(last_matched_page + 1, len(content))
+                                if page_num + 1 not in toc_pages), None)
             
-            main_section_content, end_reason = extract_section_from_items(content, page_num, main_section, alternative_names)
-            
-            if main_section_content:
-                matched_sections[main_section] = main_section_content
-                start_page = main_section_content['start_page']
-                end_page = main_section_content['end_page']
-                last_matched_page = end_page
-                logger.info(f"Matched main section '{main_section}' from page {start_page} to {end_page}. Reason: {end_reason}")
-                section_found = True
-                break
+            if search_page is not None:
+                first_heading = bisect_left(heading_pages, search_page)
+                main_section_content, end_reason = extract_section_from_index(content, heading_index, first_heading, main_section, alternative_names)
+                metrics.inc("section_lookups_total", method="scan")
         
-        if not section_found:
+        if main_section_content:
+            matched_sections[main_section] = main_section_content
+            start_page = main_section_content['start_page']
+            end_page = main_section_content['end_page']
+            last_matched_page = end_page
+            logger.info(f"Matched main section '{main_section}' from page {start_page} to {end_page}. Reason: {end_reason}")
+        else:
             matched_sections[main_section] = create_empty_section()
             logger.warning(f"No match found for main section '{main_section}'")
             # Move to the next page for the next section search
@@ -69,107 +176,153 @@ def match_sections(content, pdf_path):
     
     return matched_sections
 
+def locate_section_heading(heading_index, heading_pages, toc_locator, toc_pages, page_offset, target, alternative_names):
+    """Find the target's heading near the page the TOC gives for it.
+
+    Returns (heading position, TOC entry), or (None, None) when the target is
+    not in the TOC or no matching heading is close to its printed pages.
+    """
+    located = toc_locator.locate(target)
+    if located is None:
+        return None, None
+    toc_entry, start_page, end_page = located
+    
+    slack = TOC_PAGE_SLACK if page_offset is not None else TOC_PAGE_SLACK_UNCALIBRATED
+    offset = page_offset or 0
+    first_page_idx = max(0, start_page + offset - 1 - slack)
+    last_page_idx = max(start_page, end_page or start_page) + offset - 1 + slack
+    
+    candidates = []
+    for position in range(bisect_left(heading_pages, first_page_idx), bisect_left(heading_pages, last_page_idx + 1)):
+        entry = heading_index[position]
+        if entry.page_idx + 1 not in toc_pages and match_heading(entry.value, target, alternative_names):
+            candidates.append(position)
+    if not candidates:
+        logger.debug(f"TOC entry '{toc_entry.title}' for '{target}' has no matching heading near page {start_page}")
+        return None, None
+    
+    # Prefer the heading numbered like the TOC entry
+    numbered = [position for position in candidates if heading_index[position].section_num == toc_entry.section_number]
+    position = (numbered or candidates)[0]
+    logger.debug(f"Located '{target}' via TOC entry '{toc_entry.title}' (page {start_page}) at page {heading_index[position].page}")
+    return position, toc_entry
+
 def create_empty_section():
-    return {
-        "content": "Not available",
-        "start_page": None,
-        "end_page": None,
-        "section_num": None,
-        "images": [],
-        "tables": []
-    }
-
-def extract_section_from_items(content, start_page, target, alternative_names):
-    logger.debug(f"Extracting section content for '{target}' starting from page {start_page}")
-    section_content = []
-    images = []
-    tables = []
-    started = False
-    current_page = start_page
-    section_num = None
-    current_subsection = None
-    end_reason = "Reached end of document"
-    start_page_num = None
-
-    def is_matching_heading(heading, target, alternative_names):
-        cleaned_heading = re.sub(r'^\d+(\.\d+)*\s*', '', heading).strip().lower()
-        
-        # First, check for exact match with target
-        if cleaned_heading == target.lower():
-            logger.debug(f"Exact match found for '{target}': '{heading}'")
-            return target
-
-        # If no exact match with target, check for similarity with target
-        if similarity(cleaned_heading, target.lower()) > 0.8:
-            logger.debug(f"Similarity match found for '{target}': '{heading}'")
-            return target
-
-        # If still no match, check alternative names
-        for alt_name in alternative_names.get(target, []):
-            if cleaned_heading == alt_name.lower():
-                logger.debug(f"Exact match found for alternative name '{alt_name}': '{heading}'")
-                return alt_name
-            if similarity(cleaned_heading, alt_name.lower()) > 0.8:
-                logger.debug(f"Similarity match found for alternative name '{alt_name}': '{heading}'")
-                return alt_name
-        
+    return empty_section()
+
+@lru_cache(maxsize=8192)
+def normalize_heading(heading):
+    return re.sub(r'^\d+(\.\d+)*\s*', '', heading).strip().lower()
+
+def build_heading_index(content):
+    """Walk the page/item list once and record the position of every heading"""
+    heading_index = []
+    for page_idx, item_idx, page, value in iter_heading_items(content):
+        heading_index.append(HeadingEntry(
+            page_idx=page_idx,
+            item_idx=item_idx,
+            page=page,
+            section_num=extract_section_number(value),
+            text=normalize_heading(value),
+            value=value
+        ))
+    return heading_index
+
+def iter_heading_items(content):
+    """Yield (page_idx, item_idx, page number, heading text); page stores answer from their index"""
+    if isinstance(content, PageStore):
+        yield from content.headings()
+        return
+    for page_idx, page in enumerate(content):
+        for item_idx, item in enumerate(page['items']):
+            if item.get('type', '').lower() == 'heading':
+                yield page_idx, item_idx, page['page'], item.get('value', '')
+
+def extract_section_from_index(content, heading_index, first_heading, target, alternative_names):
+    logger.debug(f"Extracting section content for '{target}' starting from heading {first_heading}")
+    
+    # Find the first heading at or after first_heading that matches the target
+    start = None
+    for position in range(first_heading, len(heading_index)):
+        matched_name = match_heading(heading_index[position].value, target, alternative_names)
+        if matched_name:
+            start = position
+            break
+    
+    if start is None:
+        logger.warning(f"Section '{target}' not found")
+        return None, "Section not found"
+    
+    start_entry = heading_index[start]
+    section_num = start_entry.section_num
+    logger.info(f"Started section '{matched_name}' with number {section_num} on page {start_entry.page}")
+    
+    # The section runs until the next heading that opens another main section
+    stop_entry = None
+    for position in range(start + 1, len(heading_index)):
+        if is_next_main_section(heading_index[position].value, section_num, target, alternative_names):
+            stop_entry = heading_index[position]
+            break
+    
+    builder = collect_section_items(content, start_entry, stop_entry, subsection_labeller(target, alternative_names))
+    
+    if stop_entry:
+        end_reason = f"Next main section found: '{stop_entry.value}'"
+        end_page = stop_entry.page - 1
+    else:
+        end_reason = "Reached end of document"
+        end_page = content[-1]['page']
+    logger.info(f"Ended section '{target}' on page {end_page}. {end_reason}")
+    
+    span = [[start_entry.page_idx, start_entry.item_idx], [stop_entry.page_idx, stop_entry.item_idx] if stop_entry else None]
+    return builder.build(start_entry.page, end_page, section_num, span), end_reason
+
+def subsection_labeller(target, alternative_names):
+    """Heading -> template subsection title for target, or None when the template has no subsections for it"""
+    extractor = get_subsection_extractor(tuple(alternative_names))
+    if extractor is None:
         return None
+    return extractor.labeller(target)
 
-    for page_num, page in enumerate(content[start_page:], start=start_page):
-        current_page = page['page']
+def collect_section_items(content, start_entry, stop_entry, label_subsection=None):
+    """Walk the section's items once into a SectionBuilder, filing them under template subsections"""
+    builder = SectionBuilder()
+    last_page_idx = stop_entry.page_idx if stop_entry else len(content) - 1
+    
+    for page_idx in range(start_entry.page_idx, last_page_idx + 1):
+        page = content[page_idx]
+        items = page['items']
+        first_item = start_entry.item_idx if page_idx == start_entry.page_idx else 0
+        last_item = stop_entry.item_idx if stop_entry and page_idx == stop_entry.page_idx else len(items)
         
-        for item in page['items']:
+        for item_idx in range(first_item, last_item):
+            item = items[item_idx]
             item_type = item.get('type', '').lower()
             item_value = item.get('value', '')
-
-            if item_type == 'heading':
-                matched_name = is_matching_heading(item_value, target, alternative_names)
-                if matched_name and not started:
-                    started = True
-                    start_page_num = current_page
-                    section_num = extract_section_number(item_value)
-                    section_content.append(item_value)
-                    current_subsection = item_value
-                    logger.info(f"Started section '{matched_name}' with number {section_num} on page {current_page}")
-                elif started and is_next_main_section(item_value, section_num, target, alternative_names):
-                    end_reason = f"Next main section found: '{item_value}'"
-                    logger.info(f"Ended section '{target}' on page {current_page - 1}. {end_reason}")
-                    return create_section_dict(section_content, current_page - 1, start_page_num, section_num, images, tables), end_reason
-                elif started:
-                    section_content.append(item_value)
-                    current_subsection = item_value
             
-            elif started:
-                if item_type == 'text':
-                    if current_subsection:
-                        section_content.append(f"{current_subsection}:\n{item_value}")
-                    else:
-                        section_content.append(item_value)
-                elif item_type == 'image':
-                    images.append(item)
-                    section_content.append(f"[Image: {item.get('alt', 'No description')}]")
-                elif item_type == 'table':
-                    tables.append(item)
-                    section_content.append(f"[Table: {item.get('md', 'No table content')}]")
-    
-    if started:
-        logger.info(f"Ended section '{target}' on page {current_page}. {end_reason}")
-        return create_section_dict(section_content, current_page, start_page_num, section_num, images, tables), end_reason
+            if item_type == 'heading':
+                heading_idx = builder.add_heading(item_value, page['page'], extract_section_number(item_value))
+                title = label_subsection(item_value) if label_subsection else None
+                if title:
+                    builder.open_subsection(title, heading_idx)
+            elif item_type == 'text':
+                builder.add_text(item_value)
+            elif item_type == 'image':
+                builder.add_image(item, page['page'])
+            elif item_type == 'table':
+                builder.add_table(item, page['page'])
     
-    logger.warning(f"Section '{target}' not found")
-    return None, "Section not found"
+    return builder
+
+def match_heading(heading, target, alternative_names):
+    matched_name = get_heading_matcher(alternative_names).match(heading, target)
+    # Called for every heading and target; skip building the message unless it is logged
+    if matched_name and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Match found for '{target}' via '{matched_name}': '{heading}'")
+    return matched_name
 
 def is_matching_heading(heading, target, alternative_names):
-    cleaned_heading = re.sub(r'^\d+(\.\d+)*\s*', '', heading).strip().lower()
-    
-    if similarity(cleaned_heading, target.lower()) > 0.8:
-        return True
-    
-    for alt_name in alternative_names.get(target, []):
-        if similarity(cleaned_heading, alt_name.lower()) > 0.8:
-            return True
-    
-    return False
+    return match_heading(heading, target, alternative_names) is not None
 
 def extract_section_number(heading):
     match = re.match(r'^(\d+(\.\d+)*)', heading)
@@ -202,16 +355,6 @@ def is_date(string):
             return True
     return False
 
-def create_section_dict(content, end_page, start_page, section_num, images, tables):
-    return {
-        "content": '\n\n'.join(content),
-        "start_page": start_page,
-        "end_page": end_page,
-        "section_num": section_num,
-        "images": images,
-        "tables": tables
-    }
-
 def is_toc_page(page_content):
     toc_patterns = [
         r'\d+(\.\d+)*\s+[A-Z].*\.{3,}',  # Numbered section with dots
@@ -221,37 +364,67 @@ def is_toc_page(page_content):
     text = ' '.join([item.get('value', '') for item in page_content.get('items', [])])
     return any(re.search(pattern, text, re.MULTILINE) for pattern in toc_patterns)
 
-def identify_toc_pages_pdfminer(pdf_path):
+def is_toc_line(text):
+    return bool(re.search(r'\d+(\.\d+)*\s+[A-Z].*\.{3,}', text)) or \
+           bool(re.search(r'^(\d+\.?)+\s+', text)) or \
+           ('.' * 10 in text and re.search(r'\d+$', text.strip()))
+
+def detect_toc_pages(page_texts):
+    """Find the table of contents in an iterable of (page_number, page_text).
+
+    Consumes the iterable lazily and stops at the first page after the TOC.
+    """
     toc_pages = []
     toc_started = False
-    toc_ended = False
     
-    def is_toc_line(text):
-        return bool(re.search(r'\d+(\.\d+)*\s+[A-Z].*\.{3,}', text)) or \
-               bool(re.search(r'^(\d+\.?)+\s+', text)) or \
-               ('.' * 10 in text and re.search(r'\d+$', text.strip()))
-
-    for page_layout in extract_pages(pdf_path):
-        page_number = page_layout.pageid
-        page_text = ""
-        
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                page_text += element.get_text()
-        
-        if not toc_started and "Table of Contents" in page_text:
+    for page_number, page_text in page_texts:
+        if not toc_started and "table of contents" in page_text.lower():
             toc_started = True
             toc_pages.append(page_number)
             logger.info(f"Detected start of table of contents on page {page_number}")
             continue
         
-        if toc_started and not toc_ended:
+        if toc_started:
             if any(is_toc_line(line) for line in page_text.split('\n')):
                 toc_pages.append(page_number)
-                logger.info(f"Detected table of contents on page {page_number}")
+                logger.debug(f"Detected table of contents on page {page_number}")
             else:
-                toc_ended = True
                 logger.info(f"Table of contents ended before page {page_number}")
                 break
     
-    return toc_pages
\ No newline at end of file
+    return toc_pages
+
+def identify_toc_pages(content, pdf_path=None, max_pages=TOC_SEARCH_PAGES):
+    """Identify TOC pages from the LlamaParse page text, using pdfminer only if the text is missing"""
+    window = content[:max_pages]
+    if window and all('text' in page for page in window):
+        return detect_toc_pages((page_num + 1, page['text']) for page_num, page in enumerate(window))
+    
+    if pdf_path:
+        return identify_toc_pages_pdfminer(pdf_path, max_pages)
+    return []
+
+def identify_toc_pages_pdfminer(pdf_path, max_pages=TOC_SEARCH_PAGES):
+    file_hash = file_sha256(pdf_path)
+    if file_hash in toc_page_cache:
+        metrics.inc("toc_cache_total", result="hit")
+        return list(toc_page_cache[file_hash])
+    metrics.inc("toc_cache_total", result="miss")
+    # pdfminer is only needed for PDFs without a text layer; importing it up front slows every import of this module
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LAParams, LTTextContainer
+    
+    def page_texts():
+        # boxes_flow=None skips the hierarchical text box grouping, which
+        # is the expensive part of layout analysis and irrelevant to line matching
+        for page_layout in extract_pages(pdf_path, maxpages=max_pages, laparams=LAParams(boxes_flow=None)):
+            page_text = ""
+            for element in page_layout:
+                if isinstance(element, LTTextContainer):
+                    page_text += element.get_text()
+            yield page_layout.pageid, page_text
+    
+    with metrics.timer("toc_pdfminer_seconds"):
+        toc_pages = detect_toc_pages(page_texts())
+    toc_page_cache[file_hash] = tuple(toc_pages)
+    return toc_pages
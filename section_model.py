@@ -0,0 +1,120 @@
+# Block kinds: a heading (ref = index into "headings"), a text item (ref =
+# the text itself), a table or an image (ref = index into "tables"/"images")
+HEADING = 'h'
+TEXT = 't'
+TABLE = 'T'
+IMAGE = 'I'
+
+class SectionBuilder(object):
+    """Assembles the compact form of a matched section while its items are walked.
+
+    Every heading, paragraph and table is stored once. Text blocks refer to
+    their heading implicitly (the last heading block before them), tables and
+    images by index, and template subsections are ranges of block indexes.
+    """
+
+    def __init__(self):
+        self.headings = []
+        self.blocks = []
+        self.tables = []
+        self.images = []
+        self.subsections = {}
+        self._current_subsection = None
+        self._numbered = []
+
+    def add_heading(self, value, page, section_num=None):
+        # Parent is the closest earlier heading whose number prefixes this one;
+        # unnumbered headings hang under the last numbered heading
+        while section_num and self._numbered and not section_num.startswith(self.headings[self._numbered[-1]]["number"] + '.'):
+            self._numbered.pop()
+        parent = self._numbered[-1] if self._numbered else None
+        self.headings.append({"text": value, "page": page, "number": section_num, "parent": parent})
+        if section_num:
+            self._numbered.append(len(self.headings) - 1)
+        self.blocks.append([HEADING, len(self.headings) - 1])
+        return len(self.headings) - 1
+
+    def add_text(self, value):
+        self.blocks.append([TEXT, value])
+
+    def add_table(self, item, page):
+        self.tables.append({"page": page, "md": item.get('md', 'No table content')})
+        self.blocks.append([TABLE, len(self.tables) - 1])
+
+    def add_image(self, item, page):
+        self.images.append(dict(item, page=page))
+        self.blocks.append([IMAGE, len(self.images) - 1])
+
+    def open_subsection(self, title, heading_idx):
+        """Start filing blocks, from the heading just added, under a template subsection"""
+        subsection = self.subsections.setdefault(title, {"headings": [], "blocks": []})
+        subsection["headings"].append(heading_idx)
+        if subsection is self._current_subsection:
+            return
+        self.close_subsection(len(self.blocks) - 1)
+        subsection["blocks"].append([len(self.blocks) - 1, None])
+        self._current_subsection = subsection
+
+    def close_subsection(self, end=None):
+        if self._current_subsection is not None:
+            self._current_subsection["blocks"][-1][1] = len(self.blocks) if end is None else end
+            self._current_subsection = None
+
+    def build(self, start_page, end_page, section_num, span):
+        self.close_subsection()
+        return {
+            "start_page": start_page,
+            "end_page": end_page,
+            "section_num": section_num,
+            "span": span,
+            "headings": self.headings,
+            "blocks": self.blocks,
+            "tables": self.tables,
+            "images": self.images,
+            "subsections": self.subsections
+        }
+
+def empty_section():
+    return SectionBuilder().build(None, None, None, None)
+
+def is_matched(section):
+    return isinstance(section, dict) and section.get('start_page') is not None
+
+def iter_section_lines(section, block_ranges=None):
+    """Render blocks to the text lines the section used to store, one at a time"""
+    blocks = section.get('blocks', [])
+    headings = section.get('headings', [])
+    for start, stop in block_ranges or [(0, len(blocks))]:
+        current_heading = None
+        # Text is prefixed with its heading, which may precede the range
+        for position in range(start - 1, -1, -1):
+            if blocks[position][0] == HEADING:
+                current_heading = headings[blocks[position][1]]["text"]
+                break
+        for kind, ref in blocks[start:stop]:
+            if kind == HEADING:
+                current_heading = headings[ref]["text"]
+                yield current_heading
+            elif kind == TEXT:
+                yield f"{current_heading}:\n{ref}" if current_heading else ref
+            elif kind == TABLE:
+                yield f"[Table: {section['tables'][ref]['md']}]"
+            elif kind == IMAGE:
+                yield f"[Image: {section['images'][ref].get('alt', 'No description')}]"
+
+def section_text(section):
+    """Full text of a section, for compact sections and for documents stored with a "content" string"""
+    if not isinstance(section, dict):
+        return ""
+    if isinstance(section.get('content'), str):
+        return "" if section['content'] == "Not available" else section['content']
+    return '\n\n'.join(iter_section_lines(section))
+
+def subsection_text(section, title):
+    """Text filed under one template subsection, or "" if the section has none"""
+    subsection = section.get('subsections', {}).get(title) if isinstance(section, dict) else None
+    if not subsection:
+        return ""
+    if isinstance(subsection.get('content'), str):
+        return subsection['content']
+    return '\n\n'.join(iter_section_lines(section, subsection['blocks']))
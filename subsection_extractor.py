@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import re
+from collections import deque
+from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import product
+
+logger = logging.getLogger(__name__)
+
+# Next to this module, so subsections do not depend on the working directory (cron, rematch, benchmark)
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template.json')
+
+# Protocols use other wording for many template subsections
+subsection_aliases = {
+    "Protocol Synopsis": ["synopsis", "clinical trial summary", "protocol summary"],
+    "Trial Schema": ["schema", "trial diagram"],
+    "Schedule of Activities": ["schedule of assessments", "schedule of events", "trial calendar"],
+    "{Primary/Secondary/Exploratory} Objective + Associated Endpoint {and Estimand}": ["primary objective", "secondary objective", "exploratory objective"],
+    "Summary of Benefits and Risks": ["benefit risk assessment", "risks and benefits"],
+    "Description of Trial Design": ["trial overview", "overall trial design", "trial overview and rationale"],
+    "Selection of Trial Population": ["participant selection"],
+    "Dosing and Administration": ["drug administration", "dose modifications", "dosage and administration"],
+    "Preparation, Handling, Storage and Accountability": ["drug accountability", "packaging storage and labeling", "formulation"],
+    "Participant Assignment, Randomisation and Blinding": ["randomisation", "blinding", "randomisation criteria"],
+    "Trial Intervention Compliance": ["measures of treatment compliance", "treatment compliance"],
+    "Concomitant Therapy": ["concomitant medications", "concurrent medications", "prohibited medications", "restricted therapies"],
+    "Lost to Follow-Up": ["lost to follow up"],
+    "Adverse Events and Serious Adverse Events": ["adverse event reporting", "adverse event reporting requirements"],
+    "Pharmacokinetics": ["pharmacokinetic measurements", "pharmacokinetic assessments"],
+    "Analysis Sets": ["analysis populations"],
+    "Sample Size Determination": ["determination of sample size", "sample size"],
+    "Protocol Deviations": ["protocol violations"],
+    "Committees": ["data monitoring committee", "independent data monitoring committee"],
+    "Informed Consent Process": ["informed consent", "informed consent form"],
+    "Data Protection": ["participant confidentiality"],
+    "Data Quality Assurance": ["data quality control", "data quality control and reporting"],
+    "Source Data": ["source documents"],
+    "Clinical Laboratory Tests": ["required laboratory tests", "clinical laboratory measurements"],
+    "Prior Protocol Amendments": ["protocol amendments"]
+}
+
+# Interchangeable words, folded to one spelling in patterns and headings alike
+token_synonyms = {
+    "study": "trial",
+    "patient": "participant",
+    "patients": "participant",
+    "subject": "participant",
+    "subjects": "participant",
+    "participants": "participant",
+    "randomization": "randomisation",
+    "utilization": "utilisation",
+    "analyses": "analysis",
+    "criterion": "criteria",
+    "treatment": "intervention",
+    "treatments": "intervention",
+    "objectives": "objective",
+    "endpoints": "endpoint",
+    "assessments": "assessment",
+    "procedures": "procedure",
+    "considerations": "consideration",
+    "events": "event",
+    "&": "and"
+}
+
+# A pattern must cover at least this share of a heading's tokens to label it
+MIN_COVERAGE = 0.5
+
+def tokenize(text):
+    """Lower-cased word tokens with the section number removed and synonyms folded"""
+    text = re.sub(r'^\d+(\.\d+)*\.?\s*', '', text.strip()).lower()
+    return tuple(token_synonyms.get(token, token) for token in re.findall(r'[a-z0-9&]+', text))
+
+def title_variants(title):
+    """Expand "{Primary/Secondary} Objective {and Estimand}" style placeholders.
+
+    Each {a/b} group becomes one of its options or nothing; "(s)" plural
+    markers are dropped.
+    """
+    title = title.replace('(s)', '')
+    parts = re.split(r'\{([^}]*)\}', title)
+    choices = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            choices.append([''] + part.split('/'))
+        else:
+            choices.append([part])
+    return {' '.join(''.join(choice).split()) for choice in product(*choices)} - {''}
+
+class TokenAutomaton(object):
+    """Aho-Corasick automaton over word tokens.
+
+    find(tokens) reports every pattern occurring as a contiguous token run in
+    one pass over the tokens, however many patterns were added.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, tokens, value):
+        state = 0
+        for token in tokens:
+            if token not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][token] = len(self.goto) - 1
+            state = self.goto[state][token]
+        self.output[state].append((len(tokens), value))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(token, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+        return self
+
+    def find(self, tokens):
+        """Yield (pattern length, value) for every match"""
+        state = 0
+        for token in tokens:
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            yield from self.output[state]
+
+class SubsectionExtractor(object):
+    """Labels headings with the template subsection they introduce.
+
+    All template titles, their placeholder expansions and aliases go into one
+    token automaton, so labelling a heading costs one pass over its words
+    regardless of template size. Headings the automaton misses are compared
+    fuzzily against the subsections of their own main section only.
+    """
+
+    def __init__(self, template, section_names, aliases=subsection_aliases, threshold=0.8):
+        self.threshold = threshold
+        self.automaton = TokenAutomaton()
+        self.fuzzy = {}
+        self.sections = {}
+        for template_section, titles in template.items():
+            section = self._match_section(template_section, section_names)
+            if section is None:
+                logger.debug(f"Template section '{template_section}' has no matched section to attach to")
+                continue
+            self.sections[section] = template_section
+            self.fuzzy[section] = []
+            for title in titles:
+                for pattern in sorted(title_variants(title)) + aliases.get(title, []):
+                    tokens = tokenize(pattern)
+                    if tokens:
+                        self.automaton.add(tokens, (section, title))
+                        self.fuzzy[section].append((title, ' '.join(tokens)))
+        self.automaton.build()
+        self.label = lru_cache(maxsize=8192)(self._label)
+
+    def _match_section(self, template_section, section_names):
+        lowered = template_section.lower()
+        for name in section_names:
+            if name == lowered or SequenceMatcher(None, name, lowered).ratio() > self.threshold:
+                return name
+        return None
+
+    def _label(self, heading, section):
+        tokens = tokenize(heading)
+        if not tokens:
+            return None
+
+        # Longest template pattern found in the heading, within this section
+        best_length = 0
+        best_title = None
+        for length, (pattern_section, title) in self.automaton.find(tokens):
+            if pattern_section == section and length > best_length:
+                best_length, best_title = length, title
+        if best_title and best_length >= MIN_COVERAGE * len(tokens):
+            return best_title
+
+        joined = ' '.join(tokens)
+        for title, pattern in self.fuzzy.get(section, []):
+            if SequenceMatcher(None, joined, pattern).ratio() > self.threshold:
+                return title
+        return None
+
+    def labeller(self, section):
+        """Return heading -> subsection title (or None) for one matched section"""
+        if section not in self.sections:
+            return None
+        return lambda heading: self.label(heading, section)
+
+def load_template(path=TEMPLATE_PATH):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+@lru_cache(maxsize=None)
+def get_subsection_extractor(section_names, path=TEMPLATE_PATH):
+    """Extractor for the template at path, compiled once per process; None (with a warning) if it is missing"""
+    try:
+        template = load_template(path)
+    except FileNotFoundError:
+        logger.warning(f"Subsection template {path} not found; sections are matched without subsections")
+        return None
+    return SubsectionExtractor(template, section_names)
@@ -0,0 +1,126 @@
+import asyncio
+import time
+import unittest
+from async_parser import AllKeysFailed, AsyncLlamaParser, PageBudgetExhausted, is_quota_error
+
+class FakeBackend(object):
+    def __init__(self, api_key, **options):
+        self.api_key = api_key
+        self.options = options
+
+class FakeLlamaParse(object):
+    """Backend factory standing in for LlamaParse: documents parse into pages[file_path] pages,
+    or raise the error scripted for the key, and every call is recorded"""
+
+    def __init__(self, pages, errors=None, delay=0.001):
+        self.pages = pages
+        self.errors = errors or {}
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, api_key, **options):
+        backend = FakeBackend(api_key, **options)
+        backend.aget_json_result = lambda file_path: self.parse(api_key, file_path)
+        return backend
+
+    async def parse(self, api_key, file_path):
+        self.calls.append((api_key, file_path))
+        await asyncio.sleep(self.delay * self.pages[file_path])
+        if api_key in self.errors:
+            raise self.errors[api_key]
+        return [{"job_id": f"{api_key}-{file_path}", "pages": [{"page": n + 1} for n in range(self.pages[file_path])]}]
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+class AsyncLlamaParserTest(unittest.TestCase):
+    def test_quota_error_cools_key_down_and_retries_on_another(self):
+        backends = FakeLlamaParse({"a.pdf": 3}, errors={"key1": Exception("HTTP 429 Too Many Requests")})
+        parser = AsyncLlamaParser(["key1", "key2"], backends, per_key_concurrency=1, cooldown=60)
+        json_objs, key_index = run(parser.parse("a.pdf", pages=3))
+        self.assertEqual(key_index, 1)
+        self.assertEqual(len(json_objs[0]["pages"]), 3)
+        self.assertEqual(parser.stats["key_1"]["cooldowns"], 1)
+        self.assertEqual(parser.stats["key_2"]["pages_used"], 3)
+        self.assertEqual([key for key, _ in backends.calls], ["key1", "key2"])
+
+    def test_gives_up_after_max_attempts(self):
+        backends = FakeLlamaParse({"a.pdf": 1}, errors={"key1": Exception("boom"), "key2": Exception("boom")})
+        parser = AsyncLlamaParser(["key1", "key2"], backends, max_attempts=3)
+        with self.assertRaises(AllKeysFailed):
+            run(parser.parse("a.pdf"))
+        self.assertEqual(len(backends.calls), 3)
+
+    def test_results_name_the_key_position(self):
+        # Unset keys are skipped but the others keep their position in api_keys
+        parser = AsyncLlamaParser([None, "key2"], FakeLlamaParse({"a.pdf": 1}))
+        self.assertEqual(run(parser.parse("a.pdf"))[1], 1)
+
+    def test_page_budget_packs_jobs_and_refuses_what_does_not_fit(self):
+        backends = FakeLlamaParse({"a.pdf": 300, "b.pdf": 300, "c.pdf": 500, "d.pdf": 100})
+        parser = AsyncLlamaParser(["key1", "key2"], backends, per_key_concurrency=2, page_budget=600)
+
+        async def parse_all():
+            first = await asyncio.gather(*(parser.parse(name, pages=backends.pages[name]) for name in sorted(backends.pages)))
+            try:
+                await parser.parse("c.pdf", pages=500)
+            except PageBudgetExhausted as e:
+                return first, e
+            return first, None
+
+        results, refused = run(parse_all())
+        self.assertEqual(sorted(key_index for _, key_index in results), [0, 0, 1, 1])
+        self.assertEqual({stats["pages_used"] for stats in parser.stats.values()}, {600})
+        self.assertIsNotNone(refused)
+
+    def test_waiting_jobs_start_shortest_first(self):
+        pages = {"small0.pdf": 10, "big.pdf": 600, "small1.pdf": 10, "small2.pdf": 10}
+        backends = FakeLlamaParse(pages, delay=0.0001)
+        parser = AsyncLlamaParser(["key1"], backends, per_key_concurrency=1)
+
+        async def parse_all():
+            # small0 takes the only slot; the rest queue in submission order
+            return await asyncio.gather(*(parser.parse(name, pages=pages[name]) for name in pages))
+
+        run(parse_all())
+        self.assertEqual([name for _, name in backends.calls], ["small0.pdf", "small1.pdf", "small2.pdf", "big.pdf"])
+
+    def test_aging_bounds_how_long_a_large_job_waits(self):
+        pages = {"first.pdf": 1, "big.pdf": 30}
+        pages.update({f"small{n}.pdf": 1 for n in range(10)})
+        backends = FakeLlamaParse(pages, delay=0.0001)
+        parser = AsyncLlamaParser(["key1"], backends, per_key_concurrency=1, aging_pages=10)
+
+        async def parse_all():
+            return await asyncio.gather(*(parser.parse(name, pages=pages[name]) for name in pages))
+
+        run(parse_all())
+        # big ranks 30 + 1 * 10; small n ranks 1 + (n + 2) * 10, so only small0 and small1 go first
+        order = [name for _, name in backends.calls]
+        self.assertEqual(order.index("big.pdf"), 3)
+
+    def test_queue_stats_report_waiting_jobs(self):
+        pages = {"a.pdf": 5, "b.pdf": 7, "c.pdf": 9}
+        parser = AsyncLlamaParser(["key1"], FakeLlamaParse(pages, delay=0.01), per_key_concurrency=1)
+        futures = [parser.submit(name, pages=pages[name]) for name in pages]
+        try:
+            # Wait for the first job to start and the others to queue behind it
+            deadline = time.monotonic() + 5
+            stats = parser.queue_stats()
+            while stats["waiting"] < 2 and time.monotonic() < deadline:
+                time.sleep(0.001)
+                stats = parser.queue_stats()
+            self.assertEqual(stats["waiting"], 2)
+            self.assertEqual(stats["waiting_pages"], 16)
+            self.assertEqual(stats["in_flight_pages"], 5)
+            for future in futures:
+                future.result(timeout=5)
+        finally:
+            parser.stop()
+
+    def test_is_quota_error(self):
+        self.assertTrue(is_quota_error(Exception("Rate limit exceeded")))
+        self.assertFalse(is_quota_error(Exception("Invalid PDF")))
+
+if __name__ == "__main__":
+    unittest.main()
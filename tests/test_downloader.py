@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from downloader import DownloadError, PdfDownloader
+
+CONTENT = bytes(range(256)) * 1200  # 300 KB
+ETAG = '"v1"'
+
+class ProtocolServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), ProtocolHandler)
+        self.requests = []
+        # Number of GETs to cut off after drop_after bytes
+        self.drops = 0
+        self.drop_after = 100 * 1024
+        self.send_etag = True
+
+class ProtocolHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        if not self._exists():
+            return
+        self.send_response(200)
+        self._send_headers(len(CONTENT))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if not self._exists():
+            return
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self._send_headers(len(body))
+        self.end_headers()
+        if self.server.drops:
+            self.server.drops -= 1
+            self.wfile.write(body[:self.server.drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def _exists(self):
+        if self.path.endswith('/Prot_000.pdf'):
+            return True
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def _send_headers(self, length):
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(length))
+        if self.server.send_etag:
+            self.send_header('ETag', ETAG)
+
+class PdfDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ProtocolServer()
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/docs/Prot_000.pdf"
+        self.folder = tempfile.mkdtemp()
+        self.downloader = PdfDownloader(retries=2, backoff_factor=0, timeout=5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_download_writes_file_and_etag(self):
+        path = self.downloader.download(self.url, self.folder)
+        self.assertEqual(path, os.path.join(self.folder, 'Prot_000.pdf'))
+        self.assertEqual(self.read(path), CONTENT)
+        self.assertEqual(self.read(path + '.etag').decode(), ETAG)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+    def test_dropped_connection_resumes_with_range(self):
+        self.server.drops = 1
+        path = self.downloader.download(self.url, self.folder)
+        self.assertEqual(self.read(path), CONTENT)
+        self.assertEqual(len(self.server.requests), 2)
+        retry = self.server.requests[1]
+        # Everything received in whole chunks before the drop is kept
+        self.assertEqual(retry.get('Range'), f"bytes={64 * 1024}-")
+        self.assertEqual(retry.get('If-Range'), ETAG)
+
+    def test_current_file_is_not_downloaded_again(self):
+        self.downloader.download(self.url, self.folder)
+        self.downloader.download(self.url, self.folder)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_missing_file_is_a_permanent_error(self):
+        with self.assertRaises(DownloadError) as raised:
+            self.downloader.download(self.url.replace('Prot_000', 'Prot_404'), self.folder)
+        self.assertTrue(raised.exception.permanent)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_partial_file_without_etag_is_not_resumed(self):
+        # Left by another study's download of a same-named file
+        with open(os.path.join(self.folder, 'Prot_000.pdf.part'), 'wb') as f:
+            f.write(b'other protocol')
+        path = self.downloader.download(self.url, self.folder)
+        self.assertEqual(self.read(path), CONTENT)
+        self.assertNotIn('Range', self.server.requests[0])
+
+    def test_partial_file_of_a_changed_file_starts_over(self):
+        with open(os.path.join(self.folder, 'Prot_000.pdf.part'), 'wb') as f:
+            f.write(b'older version')
+        with open(os.path.join(self.folder, 'Prot_000.pdf.part.etag'), 'w') as f:
+            f.write('"v0"')
+        path = self.downloader.download(self.url, self.folder)
+        self.assertEqual(self.read(path), CONTENT)
+        self.assertEqual(self.server.requests[0].get('If-Range'), '"v0"')
+
+if __name__ == "__main__":
+    unittest.main()
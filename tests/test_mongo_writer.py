@@ -0,0 +1,78 @@
+import unittest
+import pymongo
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# mongomock only implements the bulk operation API of pymongo before 4.9
+MONGOMOCK_USABLE = mongomock is not None and pymongo.version_tuple[:2] < (4, 9)
+
+from mongo_writer import MongoBulkWriter, document_key
+
+class FailingCollection(object):
+    """Collection whose server is unreachable"""
+
+    def bulk_write(self, operations, ordered=True):
+        raise ConnectionError("server unreachable")
+
+@unittest.skipUnless(MONGOMOCK_USABLE, "needs mongomock and pymongo<4.9")
+class MongoBulkWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.protocols
+        self.writer = MongoBulkWriter(self.collection, flush_interval=None)
+
+    def test_write_upserts_by_nct_number(self):
+        self.assertEqual(self.writer.write([{"NCT Number": "NCT1", "drug_name": "A"}, {"NCT Number": "NCT2"}]), [])
+        self.assertEqual(self.writer.write([{"NCT Number": "NCT1", "drug_name": "B"}]), [])
+        self.assertEqual(self.collection.count_documents({}), 2)
+        self.assertEqual(self.collection.find_one({"NCT Number": "NCT1"})["drug_name"], "B")
+
+    def test_write_keeps_last_document_per_key(self):
+        self.writer.write([{"NCT Number": "NCT1", "drug_name": "A"}, {"NCT Number": "NCT1", "drug_name": "B"}])
+        self.assertEqual(self.collection.count_documents({}), 1)
+        self.assertEqual(self.collection.find_one({"NCT Number": "NCT1"})["drug_name"], "B")
+
+    def test_write_reports_per_document_failures(self):
+        self.collection.create_index("protocol_number", unique=True)
+        failures = self.writer.write([
+            {"NCT Number": "NCT1", "protocol_number": "P-1"},
+            {"NCT Number": "NCT2", "protocol_number": "P-1"}
+        ])
+        self.assertEqual([key for key, _ in failures], [{"NCT Number": "NCT2"}])
+        self.assertEqual(self.collection.count_documents({}), 1)
+        self.assertEqual(self.writer.stats["failed"], 1)
+
+    def test_write_bypasses_the_buffer(self):
+        self.writer.add({"NCT Number": "NCT1"})
+        self.writer.write([{"NCT Number": "NCT2"}])
+        self.assertEqual(self.collection.count_documents({}), 1)
+        self.assertEqual(self.writer.flush(), [])
+        self.assertEqual(self.collection.count_documents({}), 2)
+
+    def test_add_flushes_at_batch_size(self):
+        writer = MongoBulkWriter(self.collection, batch_size=2, flush_interval=None)
+        writer.add({"NCT Number": "NCT1"})
+        self.assertEqual(self.collection.count_documents({}), 0)
+        writer.add({"NCT Number": "NCT2"})
+        self.assertEqual(self.collection.count_documents({}), 2)
+
+class FailedFlushTest(unittest.TestCase):
+    def test_failed_write_drops_documents_and_raises(self):
+        writer = MongoBulkWriter(FailingCollection(), flush_interval=None)
+        writer.add({"NCT Number": "NCT1"})
+        with self.assertRaises(ConnectionError):
+            writer.flush()
+        # Nothing is left for a later flush to store behind the caller's back
+        self.assertEqual(writer._buffer, {})
+        self.assertEqual(writer.failures, [({"NCT Number": "NCT1"}, "server unreachable")])
+
+    def test_document_key_falls_back_to_protocol_number_and_source(self):
+        self.assertEqual(document_key({"NCT Number": "NCT1", "protocol_number": "P"}), {"NCT Number": "NCT1"})
+        self.assertEqual(document_key({"protocol_number": "P", "protocol_source": "a.pdf"}), {"protocol_number": "P"})
+        self.assertEqual(document_key({"protocol_number": "Protocol Number Not Found", "protocol_source": "a.pdf"}),
+                         {"protocol_source": "a.pdf"})
+
+if __name__ == "__main__":
+    unittest.main()
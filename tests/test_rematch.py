@@ -0,0 +1,59 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import pymongo
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+MONGOMOCK_USABLE = mongomock is not None and pymongo.version_tuple[:2] < (4, 9)
+
+from rematch import legacy_parses, rematch_entry
+
+@unittest.skipUnless(MONGOMOCK_USABLE, "needs mongomock and pymongo<4.9")
+class LegacyParsesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.collection = mongomock.MongoClient().db.protocols
+        for name in ["Prot_000", "Prot_001", "DrugX", "Shared"]:
+            with open(os.path.join(self.folder, f"{name}_output.json"), 'w') as f:
+                json.dump([{"page": 1, "text": "Inclusion Criteria", "md": "# Inclusion Criteria", "items": []}], f)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def targets(self):
+        return {os.path.basename(path): target for target, _, path in legacy_parses(self.folder, self.collection)}
+
+    def test_parse_is_tied_to_the_only_document_with_its_file_name(self):
+        self.collection.insert_many([
+            {"NCT Number": "NCT1", "protocol_source": "downloaded_pdfs/Prot_000.pdf"},
+            {"NCT Number": "NCT2", "protocol_source": "test/DrugX.pdf"}
+        ])
+        targets = self.targets()
+        self.assertEqual(set(targets), {"Prot_000_output.json", "DrugX_output.json"})
+        self.assertEqual(self.collection.find_one(targets["DrugX_output.json"])["NCT Number"], "NCT2")
+
+    def test_shared_or_re_ingested_file_names_are_skipped(self):
+        self.collection.insert_many([
+            {"NCT Number": "NCT1", "protocol_source": "downloaded_pdfs/Shared.pdf"},
+            {"NCT Number": "NCT2", "protocol_source": "downloaded_pdfs/Shared.pdf"},
+            # Prot_001_output.json may hold another study's protocol than the one re-ingested since
+            {"NCT Number": "NCT3", "protocol_source": "downloaded_pdfs/NCT3/Prot_001.pdf", "pdf_sha256": "ab"},
+            {"NCT Number": "NCT4", "protocol_source": "downloaded_pdfs/Prot_001.pdf"}
+        ])
+        self.assertEqual(self.targets(), {})
+
+    def test_dry_run_lists_every_parse(self):
+        entries = legacy_parses(self.folder)
+        self.assertEqual(len(entries), 4)
+        target, sections = rematch_entry(entries[0])
+        self.assertIsNone(target)
+        self.assertTrue(sections)
+
+if __name__ == "__main__":
+    unittest.main()
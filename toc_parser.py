@@ -0,0 +1,130 @@
+import re
+from collections import Counter, namedtuple
+
+# Line with a dot leader (or wide gap) before the page number, e.g. "5.1 RANDOMIZATION CRITERIA ....... 31"
+TOC_ENTRY = re.compile(r'^(?:(?P<number>\d+(?:\.\d+)*)\.?\s+)?(?P<title>\S.*?)\s*(?:\.{3,}|\s{2,})\s*(?P<page>\d+)$')
+# Line holding only a section number; some extractors put the title on a later line
+BARE_NUMBER = re.compile(r'^(?P<number>\d+(?:\.\d+)*)\.?$')
+# Lists of figures and tables are not sections
+NON_SECTION = re.compile(r'^(figure|table|listing)\s+\d+', re.IGNORECASE)
+# Running footer with the printed page number, e.g. "Page 14 of 86"
+PRINTED_PAGE = re.compile(r'Page\s+(\d+)\s+of\s+\d+', re.IGNORECASE)
+
+# Flat view of a TOC node, in document order
+TocEntry = namedtuple('TocEntry', ['section_number', 'title', 'page_number', 'depth'])
+
+def parse_toc_lines(text):
+    """Parse TOC page text into (section_number, title, page_number) tuples in order"""
+    entries = []
+    pending_numbers = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        bare = BARE_NUMBER.match(line)
+        if bare:
+            pending_numbers.append(bare.group('number'))
+            continue
+        entry = TOC_ENTRY.match(line)
+        if not entry or NON_SECTION.match(entry.group('title')):
+            continue
+        number = entry.group('number')
+        if number is None and pending_numbers:
+            number = pending_numbers.pop(0)
+        entries.append((number or "", entry.group('title').strip(), int(entry.group('page'))))
+    return entries
+
+def build_toc_tree(entries):
+    """Nest TOC entries by section number, in the shape of test_toc.json"""
+    root = {"section_number": "", "page_number": 0, "subsections": {}}
+    for section_number, title, page_number in entries:
+        node = root
+        if section_number:
+            parts = section_number.split('.')
+            # Create parents that the TOC skipped
+            for depth in range(1, len(parts)):
+                node = node["subsections"].setdefault(parts[depth - 1], {
+                    "title": "",
+                    "section_number": '.'.join(parts[:depth]),
+                    "page_number": 0,
+                    "subsections": {}
+                })
+            key = parts[-1]
+        else:
+            key = title
+        existing = node["subsections"].get(key)
+        if existing:
+            existing.update(title=title, page_number=page_number)
+        else:
+            node["subsections"][key] = {
+                "title": title,
+                "section_number": section_number,
+                "page_number": page_number,
+                "subsections": {}
+            }
+    return {"TABLE OF CONTENTS": root}
+
+def flatten_toc(tree):
+    """List the TOC nodes as TocEntry tuples in reading order"""
+    entries = []
+
+    def walk(node, depth):
+        for child in node["subsections"].values():
+            if child["title"]:
+                entries.append(TocEntry(child["section_number"], child["title"], child["page_number"], depth))
+            walk(child, depth + 1)
+
+    walk(tree["TABLE OF CONTENTS"], 1)
+    return entries
+
+def printed_page_offset(content, votes=3):
+    """Difference between physical page numbers and the printed "Page N of M" footer.
+
+    Stops reading pages once one offset has been seen votes times; otherwise
+    returns the most common offset, or None if no page has the footer.
+    """
+    offsets = Counter()
+    for page in content:
+        match = PRINTED_PAGE.search(page.get('text') or '')
+        if match:
+            offset = page['page'] - int(match.group(1))
+            offsets[offset] += 1
+            if offsets[offset] >= votes:
+                return offset
+    return offsets.most_common(1)[0][0] if offsets else None
+
+class TocLocator(object):
+    """Maps template sections to TOC entries and their printed page ranges.
+
+    match(title, target) decides whether a TOC title names the target section
+    (the HeadingMatcher used for headings). A section runs from its entry's
+    page to the page of the next entry at the same or a shallower depth.
+    """
+
+    def __init__(self, entries, match):
+        self.entries = entries
+        self.match = match
+
+    @classmethod
+    def from_pages(cls, content, toc_pages, match):
+        text = '\n'.join(page_text(content[page_num - 1]) for page_num in sorted(toc_pages) if page_num <= len(content))
+        return cls(flatten_toc(build_toc_tree(parse_toc_lines(text))), match)
+
+    def locate(self, target):
+        """Return (entry, start page, end page) for target, or None if the TOC has no match"""
+        candidates = [(entry.depth, position) for position, entry in enumerate(self.entries)
+                      if entry.page_number and self.match(entry.title, target)]
+        if not candidates:
+            return None
+        _, position = min(candidates)
+        entry = self.entries[position]
+
+        end_page = None
+        for following in self.entries[position + 1:]:
+            if following.depth <= entry.depth and following.page_number:
+                end_page = following.page_number
+                break
+        return entry, entry.page_number, end_page
+
+def page_text(page):
+    return page.get('text') or page.get('md') or '\n'.join(item.get('value', '') for item in page.get('items', []))